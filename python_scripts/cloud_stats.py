@@ -11,12 +11,13 @@ import argparse
 from netCDF4 import Dataset
 from datetime import datetime, timedelta
 from helpers import make_datelist, get_pp_fn, create_log_str, \
-    read_netcdf_dataset, get_config, save_fig_and_log, pp_exists, \
-    get_composite_str, calc_rdf, identify_clouds, load_raw_data, fit_curve
+    read_netcdf_dataset, get_config, save_fig_and_log, get_composite_str, \
+    calc_rdf_cof, calc_rdf_mask, get_cloud_catalogue, read_cloud_catalogue, \
+    load_raw_data, fit_curve, create_storage_variable, pp_complete, \
+    open_pp_file
 import numpy as np
 
 import matplotlib.pyplot as plt
-from scipy.signal import convolve2d
 
 
 ################################################################################
@@ -116,8 +117,12 @@ def create_netcdf(inargs):
     rootgroup.log = create_log_str(inargs, 'Preprocessing')
 
     # Create root dimensions and variables
+    # date is unlimited, so that the file can be extended with new dates
     for dim_name, dim_val in dimensions.items():
-        rootgroup.createDimension(dim_name, dim_val.shape[0])
+        if dim_name == 'date':
+            rootgroup.createDimension(dim_name, None)
+        else:
+            rootgroup.createDimension(dim_name, dim_val.shape[0])
         tmp_var = rootgroup.createVariable(dim_name, 'f8', dim_name)
         tmp_var[:] = dim_val
 
@@ -132,38 +137,44 @@ def create_netcdf(inargs):
 
         # Create dimensions
         for dim_name, dim_len in dimensions.items():
-            if type(dim_len) is not int:
+            if dim_name == 'date':
+                dim_len = None
+            elif type(dim_len) is not int:
                 dim_len = dim_len.shape[0]
             rootgroup.groups[g].createDimension(dim_name, dim_len)
 
         # Create variables
         for var_name, var_dims in variables.items():
-            rootgroup.groups[g].createVariable(var_name, 'f8', var_dims)
+            create_storage_variable(inargs, rootgroup.groups[g], var_name,
+                                    var_dims, dtype_key='pp_dtype')
+
+        # Progress variable, 1 for all computed days of each member
+        rootgroup.groups[g].createVariable('done', 'i1', ['date', 'ens_no'],
+                                           fill_value=0)
 
     return rootgroup
 
 
 # noinspection PyTupleAssignmentBalance
-def compute_cloud_histograms(inargs, raw_data, rootgroup, group, idate, it, ie,
+def compute_cloud_histograms(inargs, objects, rootgroup, group, idate, ie,
                              cld_size_binedges, cld_sum_binedges,
                              cld_size_sep_binedges, cld_sum_sep_binedges):
     """
-    Compute the histograms for the given parameters and wirte in netCDF file
+    Compute the histograms for the given parameters for all times of one day
+    and wirte in netCDF file
     
     Parameters
     ----------
     inargs : argparse object
       Argparse object with all input arguments
-    data : numpy array
-      2D precipitation array
+    objects : list
+      Regular and separated clouds of the day from read_cloud_catalogue
     rootgroup : ncdf rootgroup
       rootgroup to write 
     group : str
       NetCDF group name
     idate : int
       Date index
-    it : int 
-      time index
     ie : int
       Ensemble index
     cld_size_binedges : numpy array or list
@@ -175,88 +186,54 @@ def compute_cloud_histograms(inargs, raw_data, rootgroup, group, idate, it, ie,
     cld_sum_sep_binedges : numpy array or list
       Bin edges
 
-    Returns
-    -------
-    labels, labels_sep : numpy.array
-      2D array with labelled objects, for regular and separated clouds
-      
     """
     dx = float(get_config(inargs, 'domain', 'dx'))
 
-    # Identify the clouds
-    if inargs.var is 'm':
-        field = raw_data.variables['W'][idate, it, ie]
-        opt_field = (raw_data.variables['QC'][idate, it, ie] +
-                     raw_data.variables['QI'][idate, it, ie] +
-                     raw_data.variables['QS'][idate, it, ie])
-        rho = raw_data.variables['RHO'][idate, it, ie]
-        opt_thresh = 0.
-
-    else:
-        field = raw_data.variables['PREC_ACCUM'][idate, it, ie]
-        opt_field = None
-        rho = None
-        opt_thresh = None
-        # set all masked points to zero
-        field[raw_data.variables['mask'][idate, it]] = 0
-
-    labels, cld_size_list, cld_sum_list = \
-        identify_clouds(field, inargs.thresh, opt_field=opt_field,
-                        water=False, rho=rho, dx=dx, opt_thresh=opt_thresh)
-
-    # Convert to kg / h
-    cld_sum_list = np.array(cld_sum_list) * dx * dx
-    rootgroup.groups[group].variables['cld_size']\
-        [idate, it, :, ie] = np.histogram(cld_size_list,
-                                          cld_size_binedges)[0]
-    rootgroup.groups[group].variables['cld_sum']\
-        [idate, it, :, ie] = np.histogram(cld_sum_list,
-                                          cld_sum_binedges)[0]
-    rootgroup.groups[group].variables['cld_size_mean']\
-        [idate, it, ie] = np.mean(cld_size_list)
-    rootgroup.groups[group].variables['cld_sum_mean']\
-        [idate, it, ie] = np.mean(cld_sum_list)
-
-    if inargs.footprint == 0:   # Use default cross
-        footprint = [[0, 1, 0], [1, 1, 1], [0, 1, 0]]
-    else:
-        footprint = inargs.footprint
-    labels_sep, cld_size_sep_list, cld_sum_sep_list = \
-        identify_clouds(field, inargs.thresh, opt_field=opt_field,
-                        water=True, rho=rho,
-                        dx=dx, neighborhood=footprint,
-                        opt_thresh=opt_thresh)
-
-    # Convert to kg / h
-    cld_sum_sep_list = np.array(cld_sum_sep_list) * dx * dx
-    rootgroup.groups[group].variables['cld_size_sep']\
-        [idate, it, :, ie] = \
-        np.histogram(cld_size_sep_list,
-                     cld_size_sep_binedges)[0]
-    rootgroup.groups[group].variables['cld_sum_sep']\
-        [idate, it, :, ie] = \
-        np.histogram(cld_sum_sep_list,
-                     cld_sum_sep_binedges)[0]
-    rootgroup.groups[group].variables['cld_size_sep_mean']\
-        [idate, it, ie] = np.mean(cld_size_sep_list)
-    rootgroup.groups[group].variables['cld_sum_sep_mean']\
-        [idate, it, ie] = np.mean(cld_sum_sep_list)
-
-    return labels, labels_sep
-
-
-def compute_rdfs(inargs, labels, labels_sep, data, rdf_mask, rootgroup, group,
-                 idate, it, ie):
+    ntime = rootgroup.groups[group].dimensions['time'].size
+    for obj, sufx, size_binedges, sum_binedges in \
+            zip(objects, ['', '_sep'],
+                [cld_size_binedges, cld_size_sep_binedges],
+                [cld_sum_binedges, cld_sum_sep_binedges]):
+        member_mask = obj['member'] == ie
+        time_list = obj['time'][member_mask]
+
+        # Convert to m^2 and kg / h
+        cld_size_list = obj['size'][member_mask] * dx * dx
+        cld_sum_list = obj['sum'][member_mask] * dx * dx
+
+        # Histograms and means for each time
+        size_hist = np.zeros((ntime, len(size_binedges) - 1))
+        sum_hist = np.zeros((ntime, len(sum_binedges) - 1))
+        size_mean = np.zeros(ntime)
+        sum_mean = np.zeros(ntime)
+        for it in range(ntime):
+            size_hist[it] = np.histogram(cld_size_list[time_list == it],
+                                         size_binedges)[0]
+            sum_hist[it] = np.histogram(cld_sum_list[time_list == it],
+                                        sum_binedges)[0]
+            size_mean[it] = np.mean(cld_size_list[time_list == it])
+            sum_mean[it] = np.mean(cld_sum_list[time_list == it])
+
+        rootgroup.groups[group].variables['cld_size' + sufx]\
+            [idate, :, :, ie] = size_hist
+        rootgroup.groups[group].variables['cld_sum' + sufx]\
+            [idate, :, :, ie] = sum_hist
+        rootgroup.groups[group].variables['cld_size' + sufx + '_mean']\
+            [idate, :, ie] = size_mean
+        rootgroup.groups[group].variables['cld_sum' + sufx + '_mean']\
+            [idate, :, ie] = sum_mean
+
+
+def compute_rdfs(inargs, objects, rdf_mask, rootgroup, group, idate, it, ie):
     """
     Compute RDF. Type given by input parameters
     
     Parameters
     ----------
     inargs
-    labels
-    labels_sep
-    data
-    rdf_mask
+    objects : list
+      Regular and separated clouds of the day from read_cloud_catalogue
+    rdf_mask : eroded mask from calc_rdf_mask or None
     rootgroup
     group
     idate
@@ -264,26 +241,26 @@ def compute_rdfs(inargs, labels, labels_sep, data, rdf_mask, rootgroup, group,
     ie
 
     """
-
-    # Compute mask for rdfs
-    r_max = inargs.rdf_r_max
-    kernel_size = r_max * 2 + 1
-    y_tmp, x_tmp = np.ogrid[-r_max:kernel_size - r_max,
-                   -r_max:kernel_size - r_max]
-    kernel = x_tmp * x_tmp + y_tmp * y_tmp <= r_max * r_max
-    if rdf_mask is not None:
-        rdf_mask = convolve2d(rdf_mask, kernel, mode='same', boundary='fill',
-                              fillvalue=1) == 0
-
-    for l, rdf_type in zip([labels, labels_sep], ['rdf', 'rdf_sep']):
-
-        if np.sum(l > 0)/np.float(l.size) > inargs.rdf_cov_thresh:
-            rdf, radius = calc_rdf(l, data,
-                                   normalize=~inargs.rdf_non_norm,
-                                   dx=float(get_config(inargs, 'domain', 'dx')),
-                                   r_max=inargs.rdf_r_max,
-                                   dr=inargs.rdf_dr,
-                                   mask=rdf_mask)
+    shape = (get_config(inargs, 'domain', 'ana_irange'),
+             get_config(inargs, 'domain', 'ana_jrange'))
+    npix = shape[0] * shape[1]
+
+    for obj, rdf_type in zip(objects, ['rdf', 'rdf_sep']):
+        obj_mask = (obj['member'] == ie) & (obj['time'] == it)
+        cld_size = obj['size'][obj_mask]
+
+        if np.sum(cld_size)/np.float(npix) > inargs.rdf_cov_thresh:
+            # Same objects as the legacy centers of mass in calc_rdf
+            num = np.count_nonzero(cld_size) + int(np.sum(cld_size) < npix)
+            cof = np.array([obj['centroid_x'][obj_mask],
+                            obj['centroid_y'][obj_mask]]).T
+            rdf, radius = calc_rdf_cof(cof[:max(num - 1, 0)], shape,
+                                       normalize=~inargs.rdf_non_norm,
+                                       dx=float(get_config(inargs, 'domain',
+                                                           'dx')),
+                                       r_max=inargs.rdf_r_max,
+                                       dr=inargs.rdf_dr,
+                                       mask=rdf_mask)
         else:
             rdf = np.nan
 
@@ -310,56 +287,82 @@ def cloud_stats(inargs):
     prec_freq_binedges, cld_size_binedges, cld_sum_binedges, \
         cld_size_sep_binedges, cld_sum_sep_binedges = create_bin_edges(inargs)
 
-    # Make netCDF file
-    rootgroup = create_netcdf(inargs)
+    # Make netCDF file or open it to resume the computation
+    rootgroup = open_pp_file(inargs, create_netcdf)
+    datelist = make_datelist(inargs)
 
     for group in rootgroup.groups:
+        # Days and members which are not done yet
+        nens = rootgroup.groups[group].dimensions['ens_no'].size
+        done = np.zeros((len(datelist), nens), dtype=int)
+        tmp = np.ma.filled(rootgroup.groups[group].variables['done'][:], 0)
+        done[:tmp.shape[0]] = tmp
+        if np.all(done == 1):
+            continue
+
+        # Clouds from the catalogue, the raw precipitation is needed for the
+        # precipitation histograms and the radar mask
         if inargs.var == 'PREC_ACCUM':
+            catalogue = get_cloud_catalogue(inargs, group, 'PREC_ACCUM',
+                                            radar_mask_type=inargs.radar_mask)
             raw_data = load_raw_data(inargs, 'PREC_ACCUM', group,
                                      radar_mask_type=inargs.radar_mask)
         else:
-            raw_data = load_raw_data(inargs, ['W', 'QC', 'QI', 'QS', 'RHO'],
-                                     group, radar_mask_type=False,
-                                     lvl=inargs.lvl)
+            catalogue = get_cloud_catalogue(inargs, group, 'm', lvl=inargs.lvl)
+
+        for idate, date in enumerate(datelist):
+            if np.all(done[idate] == 1):
+                continue
+
+            # Clouds of the day, shared by all members
+            objects = [read_cloud_catalogue(catalogue, idate, sep) for sep in
+                       [False, True]]
+
+            # Eroded masks for rdfs, shared by all members
+            ntime = rootgroup.groups[group].dimensions['time'].size
+            if inargs.radar_mask == 'hour' and inargs.var == 'PREC_ACCUM':
+                mask_var = raw_data.variables['mask_hour']
+                rdf_masks = [calc_rdf_mask(mask_var[idate, it],
+                                           inargs.rdf_r_max)
+                             for it in range(ntime)]
+            else:
+                rdf_masks = [None] * ntime
+
+            for ie in range(nens):
+                if done[idate, ie] == 1:
+                    continue
+
+                # 1st: compute cloud size and precipitation histograms for
+                # all times at once
+                compute_cloud_histograms(inargs, objects, rootgroup, group,
+                                         idate, ie, cld_size_binedges,
+                                         cld_sum_binedges,
+                                         cld_size_sep_binedges,
+                                         cld_sum_sep_binedges)
 
-        for idate, date in enumerate(make_datelist(inargs)):
-            for ie in range(rootgroup.groups[group].dimensions['ens_no'].size):
                 # Now do the actually new calculation
-                for it in range(rootgroup.groups[group].dimensions['time'].
-                                size):
+                for it in range(ntime):
 
                     if inargs.var == 'PREC_ACCUM':
-                        # 1st: calculate totla precipitation histogram
+                        # 2nd: calculate totla precipitation histogram
                         data = raw_data.variables['PREC_ACCUM'][idate, it, ie]
                         rootgroup.groups[group].variables['prec_freq']\
                             [idate, it, :, ie] = np.histogram(data,
                                                         prec_freq_binedges)[0]
-                    else:
-                        data = raw_data.variables['W'][idate, it, ie]
-
-                    # 2nd: compute cloud size and precipitation histograms
-                    tmp = compute_cloud_histograms(inargs, raw_data, rootgroup,
-                                                   group, idate, it, ie,
-                                                   cld_size_binedges,
-                                                   cld_sum_binedges,
-                                                   cld_size_sep_binedges,
-                                                   cld_sum_sep_binedges)
-                    labels, labels_sep = tmp
 
                     # 3rd: Compute radial distribution function
                     if inargs.radar_mask in ['total', 'day']:
                         raise Exception('radar_mask type no longer supported \
                                         for RDF')
-                    if inargs.radar_mask == 'hour' and \
-                                    inargs.var == 'PREC_ACCUM':
-                        compute_rdfs(inargs, labels, labels_sep, data,
-                                     raw_data.variables[
-                                         'mask'][idate, it].astype(int),
-                                     rootgroup, group, idate, it, ie)
-                    else:
-                        compute_rdfs(inargs, labels, labels_sep, data,
-                                     None, rootgroup, group, idate, it, ie)
-        raw_data.close()
+                    compute_rdfs(inargs, objects, rdf_masks[it], rootgroup,
+                                 group, idate, it, ie)
+
+                # Mark day of member as done
+                rootgroup.groups[group].variables['done'][idate, ie] = 1
+                rootgroup.sync()
+        if inargs.var == 'PREC_ACCUM':
+            raw_data.close()
+        catalogue.close()
 
     # Close NetCDF file
     rootgroup.close()
@@ -808,7 +811,7 @@ def main(inargs):
     """
 
     # Check if pre-processed file exists
-    if (pp_exists(inargs) is False) or (inargs.recompute is True):
+    if (pp_complete(inargs) is False) or (inargs.recompute is True):
         print('Compute preprocessed file: ' + get_pp_fn(inargs))
         # Call preprocessing routine with arguments
         cloud_stats(inargs)
@@ -1014,6 +1017,17 @@ if __name__ == '__main__':
                         help='If given, recompute pre-processed file.')
     parser.set_defaults(recompute=False)
 
+    # Arguments which change the pre-processed file
+    parser.set_defaults(pp_args=['date_start', 'date_end', 'time_start',
+                                 'time_end', 'time_inc', 'nens', 'radar_mask',
+                                 'footprint', 'thresh', 'var', 'lvl',
+                                 'prec_freq_binedges', 'cld_size_bin_triplet',
+                                 'cld_sum_bin_triplet',
+                                 'cld_size_sep_bin_triplet',
+                                 'cld_sum_sep_bin_triplet', 'rdf_r_max',
+                                 'rdf_dr', 'rdf_non_norm', 'rdf_cov_thresh'],
+                        pp_version='cloud_stats-1')
+
     args = parser.parse_args()
 
     main(args)
\ No newline at end of file
@@ -10,6 +10,10 @@ This script contains helper functions.
 # import modules
 import os
 import sys
+import json
+import hashlib
+from collections import deque
+from multiprocessing import Pool
 import yaml
 import numpy as np
 from netCDF4 import Dataset, date2num
@@ -18,7 +22,7 @@ from subprocess import check_output
 from git import Repo
 try:
     from cosmo_utils.pyncdf import getfobj_ncdf_timeseries
-    from cosmo_utils.helpers import yyyymmddhh_strtotime
+    from cosmo_utils.helpers import yyyymmddhh_strtotime, ddhhmmss
 except:
     print 'No cosmo_utils detected, some things might not work.'
 from numpy.ma import masked_array
@@ -27,15 +31,79 @@ from scipy.ndimage.morphology import binary_erosion
 from scipy.ndimage.filters import maximum_filter
 from skimage import morphology
 from scipy.optimize import leastsq
+from scipy.spatial import cKDTree
+from scipy.signal import fftconvolve
 from mpl_toolkits.basemap import Basemap
 import matplotlib.pyplot as plt
 
 
 # Define functions
+# Environment snapshot of this process, see get_provenance
+provenance = {}
+
+
+def get_provenance(inargs):
+    """
+    Captures the environment snapshot (Anaconda install details and
+    environment yml file) and the git hash once per process.
+
+    The snapshot is saved in preproc_data/provenance/ under a key which
+    identifies the environment (python prefix and version and the
+    modification time of the conda-meta directory, which changes when
+    packages are installed). If the file for the current key exists, conda
+    is not called at all.
+
+    Parameters
+    ----------
+    inargs : argparse object
+      Argparse object with all input arguments
+
+    Returns
+    -------
+    provenance : dict
+      Dictionary with environment key, snapshot file name and git hash
+    """
+    if len(provenance) == 0:
+        git_dir = os.getcwd().rsplit('/', 1)[0]
+        git_hash = str(Repo(git_dir).heads[0].commit)
+
+        conda_meta = os.path.join(sys.prefix, 'conda-meta')
+        if os.path.isdir(conda_meta):
+            env_mtime = os.path.getmtime(conda_meta)
+        else:
+            env_mtime = 0
+        key_str = ' '.join([sys.prefix, sys.version, str(env_mtime)])
+        env_key = hashlib.sha1(key_str.encode('utf-8')).hexdigest()[:16]
+
+        snapshot_dir = (get_config(inargs, 'paths', 'preproc_data') +
+                        'provenance/')
+        snapshot_fn = snapshot_dir + env_key + '.txt'
+        if not os.path.isfile(snapshot_fn):
+            conda_info = check_output(['conda', 'info'])
+            conda_env = check_output(['conda', 'env', 'export'])
+            snapshot_str = ("""
+Anaconda install details\n
+------------------------\n
+%s\n
+\n
+Anaconda environment yml file\n
+-----------------------------
+%s\n\n""" % (conda_info, conda_env))
+            if not os.path.isdir(snapshot_dir):
+                os.makedirs(snapshot_dir)
+            with open(snapshot_fn, 'w') as f:
+                f.write(snapshot_str)
+
+        provenance.update({'env_key': env_key, 'snapshot_fn': snapshot_fn,
+                           'git_hash': git_hash})
+    return provenance
+
+
 def create_log_str(inargs, step):
     """
     Function to create a log file tracking all steps from initial call to
-    figure.
+    figure. The environment is referenced by its snapshot key, see
+    get_provenance.
     
     Parameters
     ----------
@@ -53,14 +121,12 @@ def create_log_str(inargs, step):
     assert step in ['Preprocessing', 'Plotting'], \
         'Step must be Preprocessing or Plotting'
 
+    prov = get_provenance(inargs)
     time_stamp = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
-    conda_info = check_output(['conda', 'info'])
-    conda_env = check_output(['conda', 'env', 'export'])
-    pwd = check_output(['pwd'])
-    git_dir = pwd.rsplit('/', 1)[0]
-    git_hash = Repo(git_dir).heads[0].commit
+    pwd = os.getcwd()
     exe_str = ' '.join(sys.argv)
-    config_str = open('../config/' + inargs.config_file, 'r').read()
+    with open('../config/' + inargs.config_file, 'r') as f:
+        config_str = f.read()
     param_str = ''
     for key, value in vars(inargs).items():
         param_str += '--' + key + ' ' + str(value) + '\n'
@@ -85,21 +151,84 @@ Config yml file\n
 ---------------\n
 %s\n
 \n
-Anaconda install details\n
-------------------------\n
+Environment snapshot\n
+--------------------\n
 %s\n
-\n
-Anaconda environment yml file\n
------------------------------
-%s\n\n""" % (step, time_stamp, exe_str, pwd, str(git_hash), param_str,
-             config_str, conda_info, conda_env))
+in file: %s\n\n""" % (step, time_stamp, exe_str, pwd, prov['git_hash'],
+                       param_str, config_str, prov['env_key'],
+                       prov['snapshot_fn']))
 
     return log_str
 
 
+# Types of the config entries, sections given as type apply to all keys
+config_types = {
+    'paths': str,
+    'domain': {
+        'ie': int,
+        'je': int,
+        'ana_irange': int,
+        'ana_jrange': int,
+        'radar_istart': int,
+        'radar_istop': int,
+        'radar_jstart': int,
+        'radar_jstop': int,
+        'dx': float,
+    },
+    'colors': str,
+    'plotting': {
+        'date_fmt': str,
+        'page_width': float,
+        'date_chunk': int,
+    },
+}
+
+# Loaded config files, keyed by (path, modification time)
+config_cache = {}
+
+
+def load_config(inargs):
+    """
+    Loads the config yml file once per process. The file is only read again
+    if it was modified. Entries of the paths, domain, colors and plotting
+    sections are cast to the types in config_types.
+
+    Parameters
+    ----------
+    inargs : argparse object
+      Argparse object with all input arguments
+
+    Returns
+    -------
+    config : dict
+      Dictionary with all sections of the config file
+    """
+    config_fn = os.path.abspath('../config/' + inargs.config_file)
+    key = (config_fn, os.path.getmtime(config_fn))
+    if key not in config_cache:
+        with open(config_fn, 'r') as f:
+            config = yaml.safe_load(f)
+
+        # Cast to types
+        for top_key, types in config_types.items():
+            for bottom_key, value in config.get(top_key, {}).items():
+                if type(types) is dict:
+                    if bottom_key in types:
+                        config[top_key][bottom_key] = \
+                            types[bottom_key](value)
+                else:
+                    config[top_key][bottom_key] = types(value)
+
+        # Remove older versions of the same file
+        for old_key in [k for k in config_cache if k[0] == config_fn]:
+            del config_cache[old_key]
+        config_cache[key] = config
+    return config_cache[key]
+
+
 def get_config(inargs, top_key, bottom_key):
     """
-    Reads the config JSON file
+    Reads the config JSON file, see load_config
 
     Parameters
     ----------
@@ -114,8 +243,7 @@ def get_config(inargs, top_key, bottom_key):
     -------
     value : value for specified key pair
     """
-    config = yaml.safe_load(open('../config/' + inargs.config_file))
-    return config[top_key][bottom_key]
+    return load_config(inargs)[top_key][bottom_key]
 
 
 def make_datelist(inargs, out_format='yyyymmddhh'):
@@ -193,63 +321,212 @@ def get_domain_limits(inargs):
     return l11, l12, l21, l22, l11_rad, l12_rad, l21_rad, l22_rad
 
 
-def get_radar_mask(inargs):
+# Memoized bit-packed radar masks, key is the mask file name
+radar_mask_cache = {}
+
+
+def get_radar_mask_file(inargs):
     """
-    Returns a radar_mask for all analysis days
-    
+    Returns the bit-packed radar masks for all analysis days. The hourly, daily
+    and total masks are computed in one pass over the radar data and stored
+    together in one .npy file, which is memory-mapped on load.
+
     Parameters
     ----------
     inargs : argparse object
       Argparse object with all input arguments
     Returns
     -------
-    radar_mask :  numpy array
-      Has dimensions [date, time, i, j]
-      Mask where True values are masked (invalid)
+    packed_mask : numpy array
+      Flat uint8 array with the packed bits of the hourly [date, time, i, j],
+      daily [date, i, j] and total [i, j] masks, in this order
     """
-    # Check if radar_mask exists for days
-    radar_mask_fn = ('../aux_files/radar_tot_mask_' + inargs.date_start +
+    radar_mask_fn = ('../aux_files/radar_mask_' + inargs.date_start +
                      '_' + inargs.date_end + '_' + str(inargs.time_start) +
-                     '_' + str(inargs.time_end) + '.nc')
+                     '_' + str(inargs.time_end) + '_' + str(inargs.time_inc) +
+                     '.npy')
+    if radar_mask_fn in radar_mask_cache:
+        return radar_mask_cache[radar_mask_fn]
+
     if (os.path.isfile(radar_mask_fn)) and (inargs.recompute is False):
         print('Found radar mask: ' + radar_mask_fn)
-        mask_rg = Dataset(radar_mask_fn, 'r')
-        radar_mask = mask_rg.variables['radar_mask'][:]
-        mask_rg.close()
+        packed_mask = np.load(radar_mask_fn, mmap_mode='r')
     else:
         print('Compute radar mask: ' + radar_mask_fn)
-        l11, l12, l21, l22, l11_rad, l12_rad, l21_rad, l22_rad = \
-            get_domain_limits(inargs)
-
-        # Allocate netCDF file
-        mask_rg = Dataset(radar_mask_fn, 'w', format='NETCDF4')
-        datearray = np.array(make_datelist(inargs, out_format='netcdf'))
-        timearray = np.arange(inargs.time_start,
-                              inargs.time_end + inargs.time_inc,
-                              inargs.time_inc)
-        mask_rg.createDimension('date', datearray.shape[0])
-        mask_rg.createDimension('time', timearray.shape[0])
-        mask_rg.createDimension('i', get_config(inargs, 'domain', 'ana_irange'))
-        mask_rg.createDimension('j', get_config(inargs, 'domain', 'ana_jrange'))
-
-        radar_mask = mask_rg.createVariable('radar_mask', 'i1', ('date', 'time',
-                                                                 'i', 'j'))
-
-        for idate, date in enumerate(make_datelist(inargs)):
+        hour_mask = []
+        for date in make_datelist(inargs):
             datalist = get_datalist_radar(inargs, date)
-            for itime, data in enumerate(datalist):
-                # Crop data
-                radar_mask[idate, itime, :, :] = data > 100.
-                # TODO This has to go in the paper!
-        radar_mask = radar_mask[:]
-        mask_rg.close()
+            # Missing radar values are masked as well
+            # TODO This has to go in the paper!
+            hour_mask.append(np.ma.filled(np.ma.array(datalist) > 100., True))
+        hour_mask = np.array(hour_mask, dtype=bool)
+        day_mask = np.any(hour_mask, axis=1)
+        total_mask = np.any(hour_mask, axis=(0, 1))
+        np.save(radar_mask_fn, np.packbits(np.concatenate(
+            [hour_mask.ravel(), day_mask.ravel(), total_mask.ravel()])))
+        packed_mask = np.load(radar_mask_fn, mmap_mode='r')
 
-    return radar_mask
+    radar_mask_cache[radar_mask_fn] = packed_mask
+    return packed_mask
 
 
-def get_pp_fn(inargs, sufx='.nc', pure_fn=False, only_value=True):
+def get_radar_mask(inargs, radar_mask_type='hour', idate=None):
     """
-    Creates a filename for the pre-processed NetCDF file
+    Returns a radar_mask for all analysis days
+    
+    Parameters
+    ----------
+    inargs : argparse object
+      Argparse object with all input arguments
+    radar_mask_type : str
+      Options are [hour, day, total]
+    idate : int
+      If given, only the mask for this date index is returned. Not used for
+      the total mask.
+    Returns
+    -------
+    radar_mask :  numpy array
+      Boolean mask with dimensions [date, time, i, j] for hour,
+      [date, i, j] for day and [i, j] for total. The date dimension is
+      dropped if idate is given.
+      Mask where True values are masked (invalid)
+    """
+    packed_mask = get_radar_mask_file(inargs)
+
+    ndate = len(make_datelist(inargs))
+    ntime = np.arange(inargs.time_start, inargs.time_end + inargs.time_inc,
+                      inargs.time_inc).shape[0]
+    field_shape = (get_config(inargs, 'domain', 'ana_irange'),
+                   get_config(inargs, 'domain', 'ana_jrange'))
+    nfield = field_shape[0] * field_shape[1]
+
+    # Bit offset and shape of the requested mask in the packed array
+    if radar_mask_type == 'hour':
+        offset = 0
+        shape = (ndate, ntime) + field_shape
+    elif radar_mask_type == 'day':
+        offset = ndate * ntime * nfield
+        shape = (ndate,) + field_shape
+    elif radar_mask_type == 'total':
+        offset = ndate * (ntime + 1) * nfield
+        shape = field_shape
+        idate = None
+    else:
+        raise Exception('Wrong radar_mask type: ' + str(radar_mask_type))
+    if idate is not None:
+        offset += idate * int(np.prod(shape[1:]))
+        shape = shape[1:]
+
+    # Only unpack the bytes which are needed
+    nbits = int(np.prod(shape))
+    bits = np.unpackbits(packed_mask[offset // 8:
+                                     (offset + nbits + 7) // 8])
+    start = offset % 8
+    return bits[start:start + nbits].reshape(shape).astype(bool)
+
+
+def get_pp_key(inargs):
+    """
+    Creates a stable hash of everything that changes the pre-processed file:
+    the arguments listed in inargs.pp_args, the domain section and the
+    storage types of the config file and inargs.pp_version. Plotting
+    arguments do not change the hash.
+
+    Parameters
+    ----------
+    inargs : argparse object
+      Argparse object with all input arguments
+
+    Returns
+    -------
+    pp_key : str
+      Hash string
+    pp_params : dict
+      Parameters which went into the hash
+    """
+    config = load_config(inargs)
+    pp_params = {
+        'args': dict([(key, getattr(inargs, key)) for key in inargs.pp_args]),
+        'domain': config['domain'],
+        'storage': dict([(key, config['storage'][key]) for key in
+                         ['dtype', 'pp_dtype', 'pack_range']]),
+        'version': inargs.pp_version,
+    }
+    return get_params_key(pp_params), pp_params
+
+
+def get_params_key(params):
+    """
+    Creates a stable hash of a dictionary of parameters.
+
+    Parameters
+    ----------
+    params : dict
+      Parameters, must be serializable by json
+
+    Returns
+    -------
+    key : str
+      Hash string
+    """
+    params_str = json.dumps(params, sort_keys=True)
+    return hashlib.sha1(params_str.encode('utf-8')).hexdigest()[:16]
+
+
+def update_pp_index(pp_dir, pp_key, pp_params):
+    """
+    Adds the parameters of a pre-processed file to the index file in pp_dir,
+    which maps the hashes to human-readable parameters.
+
+    Parameters
+    ----------
+    pp_dir : str
+      Directory of pre-processed files
+    pp_key : str
+      Hash string from get_pp_key
+    pp_params : dict
+      Parameters from get_pp_key
+    """
+    index_fn = pp_dir + 'pp_index.yml'
+    if os.path.isfile(index_fn):
+        with open(index_fn, 'r') as f:
+            index = yaml.safe_load(f) or {}
+    else:
+        index = {}
+    if pp_key not in index:
+        # Round trip through json to store only plain types
+        index[pp_key] = json.loads(json.dumps(pp_params))
+        with open(index_fn, 'w') as f:
+            yaml.safe_dump(index, f, default_flow_style=False)
+
+
+def remove_from_pp_index(pp_dir, pp_key):
+    """
+    Removes a pre-processed file from the index file in pp_dir.
+
+    Parameters
+    ----------
+    pp_dir : str
+      Directory of pre-processed files
+    pp_key : str
+      Hash string from get_pp_key
+    """
+    index_fn = pp_dir + 'pp_index.yml'
+    if not os.path.isfile(index_fn):
+        return
+    with open(index_fn, 'r') as f:
+        index = yaml.safe_load(f) or {}
+    if pp_key in index:
+        del index[pp_key]
+        with open(index_fn, 'w') as f:
+            yaml.safe_dump(index, f, default_flow_style=False)
+
+
+def get_pp_fn(inargs, sufx='.nc', pure_fn=False):
+    """
+    Creates a filename for the pre-processed NetCDF file. The name contains
+    pp_version and the hash from get_pp_key, unless a custom pp_name is given.
+    The pp index is not changed, see add_pp_fn_to_index.
     Parameters
     ----------
     inargs : argparse object
@@ -258,41 +535,83 @@ def get_pp_fn(inargs, sufx='.nc', pure_fn=False, only_value=True):
       Str to attach at the end. Default = '.nc'
     pure_fn : bool  
       If true, path is not included.
-    only_value : bool  
-      If True [default] only values are plotted in file name
     Returns
     -------
     pp_fn : str
       Filename with path of pre-processed NetCDF file
 
     """
+    pp_dir = (get_config(inargs, 'paths', 'preproc_data') + inargs.sub_dir +
+              '/')
     if pure_fn:
         pp_fn = ''
     else:
-        pp_fn = (get_config(inargs, 'paths', 'preproc_data') + inargs.sub_dir +
-                 '/')
+        pp_fn = pp_dir
         if os.path.exists(pp_fn) is False:
             os.makedirs(pp_fn)
-    if inargs.plot_name is not '':
+    if inargs.pp_name != '':
         pp_fn += inargs.pp_name + sufx
     else:
-        for key, value in vars(inargs).items():
-            if key not in ['recompute', 'plot_name']:
-                if only_value:
-                    pp_fn += str(value) + '_'
-                else:
-                    pp_fn += key + '-' + str(value) + '_'
-        pp_fn = pp_fn[:-1] + sufx  # remove last '_'
-        # Replace ', ' with '_'
-        pp_fn = pp_fn.replace(', ', '_')
-        # Remove brackets
-        pp_fn = pp_fn.replace('[', '')
-        pp_fn = pp_fn.replace(']', '')
-    assert len(pp_fn) <= 255, ('File name too long with ' + str(len(pp_fn)) +
-                               ' ' + pp_fn)
+        pp_key, pp_params = get_pp_key(inargs)
+        pp_fn += inargs.pp_version + '_' + pp_key + sufx
     return pp_fn
 
 
+def add_pp_fn_to_index(inargs):
+    """
+    Adds the parameters of the pre-processed file to the pp index. Call this
+    only when the file is created, so that the index contains no entries for
+    files which do not exist. Files with a custom pp_name are not indexed.
+
+    Parameters
+    ----------
+    inargs : argparse object
+      Argparse object with all input arguments
+    """
+    if inargs.pp_name != '':
+        return
+    pp_dir = (get_config(inargs, 'paths', 'preproc_data') + inargs.sub_dir +
+              '/')
+    pp_key, pp_params = get_pp_key(inargs)
+    update_pp_index(pp_dir, pp_key, pp_params)
+
+
+def get_arg_str(inargs, sufx='', only_value=True):
+    """
+    Creates a string from all arguments, used as figure file name if no
+    plot_name is given.
+    Parameters
+    ----------
+    inargs : argparse object
+      Argparse object with all input arguments
+    sufx : str
+      Str to attach at the end. Default = ''
+    only_value : bool  
+      If True [default] only values are plotted in file name
+    Returns
+    -------
+    arg_str : str
+      String with all arguments
+
+    """
+    arg_str = ''
+    for key, value in sorted(vars(inargs).items()):
+        if key not in ['recompute', 'plot_name', 'pp_args', 'pp_version']:
+            if only_value:
+                arg_str += str(value) + '_'
+            else:
+                arg_str += key + '-' + str(value) + '_'
+    arg_str = arg_str[:-1] + sufx  # remove last '_'
+    # Replace ', ' with '_'
+    arg_str = arg_str.replace(', ', '_')
+    # Remove brackets
+    arg_str = arg_str.replace('[', '')
+    arg_str = arg_str.replace(']', '')
+    assert len(arg_str) <= 255, ('File name too long with ' +
+                                 str(len(arg_str)) + ' ' + arg_str)
+    return arg_str
+
+
 def pp_exists(inargs):
     """
     Check whether  preprocessed file exists.
@@ -309,10 +628,244 @@ def pp_exists(inargs):
     return os.path.isfile(get_pp_fn(inargs))
 
 
+def create_storage_variable(inargs, rootgroup, var_name, var_dims,
+                            dtype_key='dtype', **kwargs):
+    """
+    Creates a NetCDF variable with the storage type given in the storage
+    section of the config file.
+
+    For f8 and f4, NaNs are stored as they are. For i2, the variable is packed
+    with scale_factor and add_offset from the pack_range [min, max] given in
+    the config file for this variable. Variables without pack_range are
+    stored as f4. Use to_storage to prepare the data for writing packed
+    variables. Packing is only available for preloaded fields, preprocessed
+    files are written in many places and contain NaNs.
+
+    Parameters
+    ----------
+    inargs : argparse object
+      Argparse object with all input arguments
+    rootgroup : NetCDF dataset or group object
+      Where to create the variable
+    var_name : str
+      Name of variable
+    var_dims : list
+      Dimension names
+    dtype_key : str
+      Key in storage section, 'dtype' for preloaded fields or 'pp_dtype' for
+      preprocessed files
+    **kwargs
+      Passed to createVariable, e.g. chunksizes or zlib
+
+    Returns
+    -------
+    var : NetCDF variable object
+    """
+    dtype = get_config(inargs, 'storage', dtype_key)
+    if dtype_key == 'dtype':
+        valid_dtypes = ['f8', 'f4', 'i2']
+    else:
+        valid_dtypes = ['f8', 'f4']
+    if dtype not in valid_dtypes:
+        raise Exception('Wrong storage ' + dtype_key + ': ' + str(dtype))
+
+    pack_range = None
+    if dtype == 'i2':
+        pack_range = get_config(inargs, 'storage', 'pack_range').get(var_name)
+        if pack_range is None:
+            dtype = 'f4'
+
+    if dtype == 'i2':
+        vmin, vmax = [float(v) for v in pack_range]
+        var = rootgroup.createVariable(var_name, 'i2', var_dims,
+                                       fill_value=-32768, **kwargs)
+        # Packed values from -32767 to 32767, -32768 is the fill value
+        var.scale_factor = (vmax - vmin) / 65534.
+        var.add_offset = (vmax + vmin) / 2.
+        var.valid_range = np.array([-32767, 32767], dtype='i2')
+    else:
+        var = rootgroup.createVariable(var_name, dtype, var_dims, **kwargs)
+    return var
+
+
+def to_storage(var, data):
+    """
+    Prepares data for writing into a variable created with
+    create_storage_variable. For packed variables, data are clipped to the
+    packing range and NaNs are masked, so that they are stored as fill value
+    and read as masked values.
+
+    Parameters
+    ----------
+    var : NetCDF variable object
+      Variable to write to
+    data : numpy.ndarray
+      Data to write
+
+    Returns
+    -------
+    data : numpy.ndarray or numpy.ma.MaskedArray
+      Data to write
+    """
+    if 'scale_factor' not in var.ncattrs():
+        return data
+    vmax = var.add_offset + 32767 * var.scale_factor
+    vmin = var.add_offset - 32767 * var.scale_factor
+    data = np.ma.masked_invalid(np.asarray(data, dtype=float))
+    return np.ma.clip(data, vmin, vmax)
+
+
+def pp_complete(inargs):
+    """
+    Check whether the pre-processed file exists and all slices are done.
+    Files without progress variable 'done' are complete if they exist. The
+    first dimension of 'done' is date, dates which are not in the file yet
+    (e.g. in a group which was not written after an extension) are not done.
+
+    Parameters
+    ----------
+    inargs : argparse object
+      Argparse object with all input arguments
+
+    Returns
+    -------
+    pp_complete : bool
+      True if pre-processed file exists and is complete
+    """
+    if not pp_exists(inargs):
+        return False
+    rootgroup = Dataset(get_pp_fn(inargs))
+    ndate = len(make_datelist(inargs))
+    complete = True
+    for group in [rootgroup] + list(rootgroup.groups.values()):
+        if 'done' in group.variables:
+            tmp = np.ma.filled(group.variables['done'][:], 0)
+            done = np.zeros((max(ndate, tmp.shape[0]),) + tmp.shape[1:],
+                            dtype=int)
+            done[:tmp.shape[0]] = tmp
+            complete = complete and bool(np.all(done == 1))
+    rootgroup.close()
+    return complete
+
+
+def find_extendable_pp_fn(inargs):
+    """
+    Looks in the pp index for a pre-processed file with the same parameters
+    except for an earlier date_end, which can be extended to the current
+    date_end.
+
+    Parameters
+    ----------
+    inargs : argparse object
+      Argparse object with all input arguments
+
+    Returns
+    -------
+    pp_fn : str or None
+      Filename with path of the file with the latest date_end, None if there
+      is no such file
+    """
+    if inargs.pp_name != '' or 'date_end' not in inargs.pp_args:
+        return None
+    pp_dir = (get_config(inargs, 'paths', 'preproc_data') + inargs.sub_dir +
+              '/')
+    index_fn = pp_dir + 'pp_index.yml'
+    if not os.path.isfile(index_fn):
+        return None
+    with open(index_fn, 'r') as f:
+        index = yaml.safe_load(f) or {}
+
+    pp_key, pp_params = get_pp_key(inargs)
+    pp_params = json.loads(json.dumps(pp_params))
+    date_end = pp_params['args']['date_end']
+
+    found_date_end, found_fn = None, None
+    for key, params in index.items():
+        old_date_end = params['args'].get('date_end')
+        params['args']['date_end'] = date_end
+        pp_fn = pp_dir + inargs.pp_version + '_' + key + '.nc'
+        if (key != pp_key and params == pp_params and
+                old_date_end < date_end and os.path.isfile(pp_fn) and
+                (found_date_end is None or old_date_end > found_date_end)):
+            found_date_end, found_fn = old_date_end, pp_fn
+
+    # Only files with unlimited date dimension can be extended
+    if found_fn is not None:
+        rootgroup = Dataset(found_fn)
+        if not rootgroup.dimensions['date'].isunlimited():
+            found_fn = None
+        rootgroup.close()
+    return found_fn
+
+
+def open_pp_file(inargs, create_netcdf):
+    """
+    Opens the pre-processed file for computation. An existing file is opened
+    to resume the computation, unless inargs.recompute is True. A file for an
+    earlier date_end is renamed and extended with the new dates. It is moved
+    rather than copied, so the output for the earlier date_end is no longer
+    available under its own name, and its entry is removed from the pp index.
+    Otherwise a new file is created. New and renamed files are added to the pp
+    index. Use the progress variable 'done' to skip slices which are already
+    computed.
+
+    Parameters
+    ----------
+    inargs : argparse object
+      Argparse object with all input arguments
+    create_netcdf : function
+      Function of the script which creates a new pre-processed file
+
+    Returns
+    -------
+    rootgroup : NetCDF object
+    """
+    pp_fn = get_pp_fn(inargs)
+    if inargs.recompute is False:
+        if not os.path.isfile(pp_fn):
+            old_fn = find_extendable_pp_fn(inargs)
+            if old_fn is not None:
+                print('Extend pre-processed file: ' + old_fn)
+                os.rename(old_fn, pp_fn)
+                add_pp_fn_to_index(inargs)
+                old_key = os.path.basename(old_fn)[
+                    len(inargs.pp_version) + 1:-len('.nc')]
+                remove_from_pp_index(os.path.dirname(old_fn) + '/', old_key)
+        if os.path.isfile(pp_fn):
+            print('Resume pre-processed file: ' + pp_fn)
+            rootgroup = Dataset(pp_fn, 'a')
+            datearray = np.array(make_datelist(inargs, out_format='netcdf'))
+            ndate = rootgroup.dimensions['date'].size
+            assert np.array_equal(rootgroup.variables['date'][:],
+                                  datearray[:ndate]), 'Dates do not match.'
+            if ndate < datearray.shape[0]:
+                rootgroup.variables['date'][:] = datearray
+            return rootgroup
+    rootgroup = create_netcdf(inargs)
+    add_pp_fn_to_index(inargs)
+    return rootgroup
+
+
+# Preloaded files which were rebuilt in this process because of
+# inargs.recompute, they are appended to afterwards
+rebuilt_raw_fns = set()
+
+
 def load_raw_data(inargs, var, group, lvl=None, radar_mask_type=False):
     """
     This function loads the required COSMO fields and returns a netcdf object 
-    which has dimensions [date, time, ens_no, x, y]
+    which has dimensions [date, time, ens_no, x, y]. The fields of one group
+    are stored in one preloaded file, variables which are not in the file yet
+    are appended to it. Each radar mask type is stored in its own variable
+    mask_<radar_mask_type> with dimensions [date, time, x, y], so that
+    existing variables are never rewritten.
+
+    With inargs.recompute, each preloaded file is rebuilt by the first call
+    in a process, later calls append to it like without recompute.
+
+    Appending to a preloaded file is not safe while another process reads or
+    writes the same file. Run the first job for a new variable or mask type
+    alone, afterwards the file is only read.
     
     Parameters
     ----------
@@ -333,42 +886,57 @@ def load_raw_data(inargs, var, group, lvl=None, radar_mask_type=False):
 
     """
 
-    if var is not 'PREC_ACCUM' and group is 'obs':
-        raise Exception('obs only valid for PREC_ACCUM!')
-
-    # Define file name
-    var_str = ''
     if type(var) is not list:
         var = [var]
-    for v in var:
-        var_str += v + '_'
+    if var != ['PREC_ACCUM'] and group == 'obs':
+        raise Exception('obs only valid for PREC_ACCUM!')
 
+    # Define file name. All variables of a group are stored in the same file,
+    # so that it is shared between all scripts. The storage type and a hash of
+    # the storage settings are part of the name, so that a file with another
+    # precision is never reused.
     fn = (get_config(inargs, 'paths', 'preproc_data') + 'preloaded_fields/' +
-          var_str + group + '_' + inargs.date_start + '_' + inargs.date_end +
+          group + '_' + inargs.date_start + '_' + inargs.date_end +
           '_' + str(inargs.time_start) + '_' + str(inargs.time_end) + '_' +
           str(inargs.time_inc))
-    if hasattr(inargs, 'radar_mask'):
-        fn += '_' + inargs.radar_mask
     if group == 'ens':
         fn += '_' + str(inargs.nens)
-    fn += '.nc'
-
-    # check if preloaded raw data exists
-    if os.path.isfile(fn) and inargs.recompute is False:
-        print('Found preloaded file: ' + fn)
+    if lvl is not None:
+        fn += '_lvl' + str(lvl)
+    storage_params = {
+        'dtype': get_config(inargs, 'storage', 'dtype'),
+        'pack_range': get_config(inargs, 'storage', 'pack_range'),
+    }
+    fn += ('_' + storage_params['dtype'] + '_' +
+           get_params_key(storage_params) + '.nc')
+
+    # check if preloaded raw data exists, open it for writing only if
+    # something needs to be added. With inargs.recompute the file is rebuilt
+    # once per process.
+    if os.path.isfile(fn) and (inargs.recompute is False or
+                               fn in rebuilt_raw_fns):
         rootgroup = Dataset(fn)
-        return rootgroup
-
-    # If not preload the raw data, duh
-    print('Preload raw data in ' + fn)
-
-    # Create NetCDF file
-    rootgroup = Dataset(fn, 'w', format='NETCDF4')
+        # Variables which are missing or were not loaded completely
+        load_var = [v for v in var if v not in rootgroup.variables or
+                    getattr(rootgroup.variables[v], 'complete', 0) != 1]
+        load_mask = radar_mask_type is not False and (
+            'mask_' + radar_mask_type not in rootgroup.variables or
+            getattr(rootgroup.variables['mask_' + radar_mask_type],
+                    'complete', 0) != 1)
+        if len(load_var) == 0 and not load_mask:
+            print('Found preloaded file: ' + fn)
+            return rootgroup
+        rootgroup.close()
+        rootgroup = Dataset(fn, 'a')
+    else:
+        rootgroup = None
+        load_var = var
+        load_mask = radar_mask_type is not False
 
     # Set options for group
     if group in ['det', 'obs']:
         nens = 1
-    elif group is 'ens':
+    elif group == 'ens':
         nens = inargs.nens
 
     # Create dimensions (Partly copied from prec_stats.py)
@@ -380,61 +948,172 @@ def load_raw_data(inargs, var, group, lvl=None, radar_mask_type=False):
         'x': np.arange(get_config(inargs, 'domain', 'ana_irange')),
         'y': np.arange(get_config(inargs, 'domain', 'ana_jrange')),
     }
-    for dim_name, dim_val in dimensions.items():
-        rootgroup.createDimension(dim_name, dim_val.shape[0])
-        tmp_var = rootgroup.createVariable(dim_name, 'f8', dim_name)
-        tmp_var[:] = dim_val
 
-    # Create variable and arrays to temporarily save data
-    var_list = []
-    for v in var:
-        tmp_var = rootgroup.createVariable(v, 'f8', ['date', 'time', 'ens_no',
-                                                     'x', 'y'])
-        var_list.append(np.empty(tmp_var[:].shape))
+    if rootgroup is None:
+        # If not preload the raw data, duh
+        print('Preload raw data in ' + fn)
+
+        # Create NetCDF file
+        rootgroup = Dataset(fn, 'w', format='NETCDF4')
+        rebuilt_raw_fns.add(fn)
+        for dim_name, dim_val in dimensions.items():
+            rootgroup.createDimension(dim_name, dim_val.shape[0])
+            tmp_var = rootgroup.createVariable(dim_name, 'f8', dim_name)
+            tmp_var[:] = dim_val
+    else:
+        add_var = load_var + ['mask_' + str(radar_mask_type)] * load_mask
+        print('Add ' + ', '.join(add_var) + ' to preloaded file: ' + fn)
+
+    # Create variables, chunks are the fields of one member and time
+    chunksizes = (1, 1, 1, dimensions['x'].shape[0], dimensions['y'].shape[0])
+    for v in load_var:
+        if v in rootgroup.variables:
+            rootgroup.variables[v].complete = 0
+            continue
+        create_storage_variable(inargs, rootgroup, v,
+                                ['date', 'time', 'ens_no', 'x', 'y'],
+                                chunksizes=chunksizes,
+                                zlib=get_config(inargs, 'storage', 'zlib'),
+                                complevel=get_config(inargs, 'storage',
+                                                     'complevel'),
+                                shuffle=get_config(inargs, 'storage',
+                                                   'shuffle'))
 
     # If required load radar_mask
-    if radar_mask_type is not False:
-        radar_mask = get_radar_mask(inargs)
-        mask_var = rootgroup.createVariable('mask', 'i4', ['date', 'time', 'x',
-                                                           'y'])
-        # Determine radar mask
-        if radar_mask_type == 'total':
-            mask_var[:] = np.any(radar_mask, axis=(0, 1))
-        elif radar_mask_type == 'day':
-            mask_var[:] = np.any(radar_mask, axis=1)
-        elif radar_mask_type == 'hour':
-            mask_var[:] = radar_mask
+    if load_mask:
+        radar_mask = get_radar_mask(inargs, radar_mask_type)
+        mask_name = 'mask_' + radar_mask_type
+        if mask_name not in rootgroup.variables:
+            rootgroup.createVariable(mask_name, 'i1',
+                                     ['date', 'time', 'x', 'y'])
+        mask_var = rootgroup.variables[mask_name]
+        # Broadcast radar mask to [date, time, x, y]
+        if radar_mask_type == 'day':
+            radar_mask = radar_mask[:, None]
+        mask_var[:] = np.broadcast_to(radar_mask, mask_var.shape)
+        mask_var.complete = 1
 
     # Load the data, process and save it in NetCDF file
-    for idate, date in enumerate(make_datelist(inargs)):
-        print('Loading raw data for: ' + date)
+    # Each day of each member is written directly, so that only a few blocks
+    # are kept in memory
+    datelist = make_datelist(inargs)
+    tasks = [(inargs, idate, date, group, ie, load_var, lvl)
+             for idate, date in enumerate(datelist) for ie in range(nens)
+             if len(load_var) > 0]
+    for itask, blocks in enumerate(iter_raw_blocks(inargs, tasks)):
+        idate, date, ie = [tasks[itask][i] for i in [1, 2, 4]]
+        if ie == 0:
+            print('Loading raw data for: ' + date)
+        for iv, v in enumerate(load_var):
+            rootgroup.variables[v][idate, :, ie, :, :] = \
+                to_storage(rootgroup.variables[v], blocks[iv])
+
+    # Mark variables as complete and reopen file for reading
+    for v in load_var:
+        rootgroup.variables[v].complete = 1
+    rootgroup.close()
+
+    return Dataset(fn)
+
+
+def read_raw_block(inargs, idate, date, group, ie, var, lvl):
+    """
+    Reads the time series of all variables for one date and member.
 
-        # Loop over ensemble members and load fields for entire day
-        for ie in range(nens):
-            for iv, v in enumerate(var):
-                if group in ['det', 'ens']:
-                    if group == 'det':
-                        ens_no = 'det'
-                    else:
-                        ens_no = ie + 1
-                    datalist = get_datalist_model(inargs, date, ens_no, v,
-                                                  lvl=lvl)
-                elif group == 'obs':
-                    datalist = get_datalist_radar(inargs, date)
-                else:
-                    raise Exception('Wrong group.')
+    Parameters
+    ----------
+    inargs : argparse object
+      Argparse object with all input arguments
+    idate : int
+      Date index
+    date : str
+      Date in format yyyymmddhh
+    group : str
+      Which dataset. Options are [ens, det, obs]
+    ie : int
+      Ensemble index
+    var : list
+      COSMO variables to be loaded
+    lvl : int
+      Vertical level for 3D fields
+
+    Returns
+    -------
+    blocks : list
+      List with one [time, x, y] array for each variable
+    """
+    if group in ['det', 'ens']:
+        if group == 'det':
+            ens_no = 'det'
+        else:
+            ens_no = ie + 1
+        # Each model output file is opened once for all variables
+        datalist_dict = get_datalists_model(inargs, date, ens_no, var,
+                                            lvl=lvl)
 
-                # Save list in NetCDF file
-                # The loop is needed to preserve the mask!
-                for it in range(rootgroup.variables['time'].size):
-                    var_list[iv][idate, it, ie, :, :] = datalist[it]
+    blocks = []
+    for v in var:
+        if group in ['det', 'ens']:
+            datalist = datalist_dict[v]
+        elif group == 'obs':
+            datalist = get_datalist_radar(inargs, date)
+        else:
+            raise Exception('Wrong group.')
 
+        # The loop is needed to preserve the mask!
+        block = np.empty((len(datalist),) + datalist[0].shape)
+        for it in range(len(datalist)):
+            block[it, :, :] = datalist[it]
+        blocks.append(block)
+    return blocks
 
-    # Now write to file all at once!
-    for iv, v in enumerate(var):
-        rootgroup.variables[v][:] = var_list[iv]
 
-    return rootgroup
+def read_raw_block_star(task):
+    """
+    Calls read_raw_block with a tuple of arguments.
+    """
+    return read_raw_block(*task)
+
+
+def iter_raw_blocks(inargs, tasks):
+    """
+    Generator which reads the raw data blocks for all tasks in order. If the
+    number of I/O processes in the config file is larger than one, the blocks
+    are read concurrently by a process pool. Processes are used rather than
+    threads, because netCDF4 and HDF5 are not thread-safe, and the calling
+    process remains the only one writing to the preloaded file. At most
+    queue_size blocks are read ahead of the writer, which bounds the memory.
+
+    Parameters
+    ----------
+    inargs : argparse object
+      Argparse object with all input arguments
+    tasks : list
+      List of argument tuples for read_raw_block
+
+    Yields
+    ------
+    blocks : list
+      Return value of read_raw_block for each task
+    """
+    processes = get_config(inargs, 'io', 'processes')
+    if processes <= 1:
+        for task in tasks:
+            yield read_raw_block_star(task)
+        return
+
+    queue_size = max(get_config(inargs, 'io', 'queue_size'), processes)
+    pool = Pool(processes)
+    try:
+        queue = deque()
+        for task in tasks:
+            queue.append(pool.apply_async(read_raw_block_star, (task,)))
+            if len(queue) >= queue_size:
+                yield queue.popleft().get()
+        while len(queue) > 0:
+            yield queue.popleft().get()
+    finally:
+        pool.terminate()
 
 
 def get_datalist_radar(inargs, date):
@@ -487,66 +1166,102 @@ def get_datalist_radar(inargs, date):
     return datalist
 
 
-def get_datalist_model(inargs, date, ens_no, var, radar_mask=False, lvl=None):
+# File suffixes of the COSMO output files containing each variable
+model_sufx_dict = {
+    'PREC_ACCUM': '.nc_30m_surf',
+    'CAPE_ML': '.nc_30m_surf',
+    'TAU_C': '.nc_30m_surf',
+    'HPBL': '.nc_30m_surf',
+    'W': '.nc_30m',
+    'QC': '.nc_30m',
+    'QI': '.nc_30m',
+    'QS': '.nc_30m',
+    'RHO': '.nc_30m_buoy',
+    'TTENS_MPHY': '.nc_30m_buoy',
+}
+
+
+def get_datalists_model(inargs, date, ens_no, var_list, lvl=None):
     """
-    Get data time series for model output.
+    Get data time series of several variables for model output. The variables
+    are grouped by the file family they are stored in, so that each output
+    file is opened only once per time step for all requested variables. Only
+    the requested level and the analysis domain are read from the files.
+
     Parameters
     ----------
     inargs : : argparse object
       Argparse object with all input arguments
     date : str
       Date in format yyyymmddhh
-    ens_no : int or str 
+    ens_no : int or str
       Ensemble number or str in case of det
-    var : str 
-      Variable
-    radar_mask : 2D or 3D numpy array
-      Radar mask to create masked arrays
+    var_list : list
+      List of variables
     lvl : int
       Vertical level for 3D data
 
     Returns
     -------
-    datalist : list
-      List of 2D masked arrays
+    datalist_dict : dict
+      Dictionary with a list of 2D arrays for each variable
     """
-    # Get file name
+    # Get file name prefix
     ncdffn_pref = (get_config(inargs, 'paths', 'raw_data') +
                    date + '/deout_ceu_pspens/' + str(ens_no) +
                    '/OUTPUT/lfff')
-    sufx_dict = {
-        'PREC_ACCUM': '.nc_30m_surf',
-        'CAPE_ML': '.nc_30m_surf',
-        'TAU_C': '.nc_30m_surf',
-        'HPBL': '.nc_30m_surf',
-        'W': '.nc_30m',
-        'QC': '.nc_30m',
-        'QI': '.nc_30m',
-        'QS': '.nc_30m',
-        'RHO': '.nc_30m_buoy',
-        'TTENS_MPHY': '.nc_30m_buoy',
-    }
 
-    datalist = getfobj_ncdf_timeseries(ncdffn_pref,
-                                       timedelta(hours=inargs.time_start),
-                                       timedelta(hours=inargs.time_end),
-                                       timedelta(hours=inargs.time_inc),
-                                       ncdffn_sufx=sufx_dict[var],
-                                       return_arrays=True,
-                                       fieldn=var)
+    # Group variables by file family
+    sufx_vars = {}
+    for var in var_list:
+        sufx_vars.setdefault(model_sufx_dict[var], []).append(var)
 
-    # Crop data
     l11, l12, l21, l22, l11_rad, l12_rad, l21_rad, l22_rad = \
         get_domain_limits(inargs)
 
-    # Loop over individual time steps and apply mask
-    for i, data in enumerate(datalist):
+    datalist_dict = dict((var, []) for var in var_list)
+    t = timedelta(hours=inargs.time_start)
+    while t <= timedelta(hours=inargs.time_end):
+        for sufx, sufx_var_list in sorted(sufx_vars.items()):
+            rootgroup = Dataset(ncdffn_pref + ddhhmmss(t) + sufx, 'r')
+            for var in sufx_var_list:
+                # Read only the requested level and analysis window
+                ncvar = rootgroup.variables[var]
+                slices = [slice(l11, l12), slice(l21, l22)]
+                if ncvar.ndim - (ncvar.dimensions[0] == 'time') == 3:
+                    slices.insert(0, lvl)
+                if ncvar.dimensions[0] == 'time':
+                    slices.insert(0, 0)
+                datalist_dict[var].append(ncvar[tuple(slices)])
+            rootgroup.close()
+        t += timedelta(hours=inargs.time_inc)
+    return datalist_dict
 
-        if data.ndim == 3:
-            data = data[lvl]
 
-        datalist[i] = data[l11:l12, l21:l22]
-    return datalist
+def get_datalist_model(inargs, date, ens_no, var, radar_mask=False, lvl=None):
+    """
+    Get data time series for model output.
+    Parameters
+    ----------
+    inargs : : argparse object
+      Argparse object with all input arguments
+    date : str
+      Date in format yyyymmddhh
+    ens_no : int or str 
+      Ensemble number or str in case of det
+    var : str 
+      Variable
+    radar_mask : 2D or 3D numpy array
+      Radar mask to create masked arrays
+    lvl : int
+      Vertical level for 3D data
+
+    Returns
+    -------
+    datalist : list
+      List of 2D masked arrays
+    """
+    return get_datalists_model(inargs, date, ens_no, [var], lvl=lvl)[var]
 
 
 def read_netcdf_dataset(inargs):
@@ -593,7 +1308,7 @@ def save_fig_and_log(fig, rootgroup, inargs, plot_type='', datestr=None,
     if not os.path.exists(plotdir):
         os.makedirs(plotdir)
     if inargs.plot_name == '':
-        plotfn = plotdir + plot_type + get_pp_fn(inargs, sufx='', pure_fn=True)
+        plotfn = plotdir + plot_type + get_arg_str(inargs)
     else:
         plotfn = plotdir + plot_type + '_' + inargs.plot_name
     if datestr is not None:
@@ -612,8 +1327,7 @@ def save_fig_and_log(fig, rootgroup, inargs, plot_type='', datestr=None,
 
     # Save log file
     if inargs.plot_name == '':
-        logfn = plotdir + plot_type + get_pp_fn(inargs, sufx='.log',
-                                                pure_fn=True)
+        logfn = plotdir + plot_type + get_arg_str(inargs, sufx='.log')
     else:
         logfn = plotdir + plot_type + '_' + inargs.plot_name + '.log'
     logf = open(logfn, 'w+')
@@ -662,6 +1376,8 @@ def detect_peaks(image, neighborhood = [[0,1,0],[1,1,1],[0,1,0]]):
     Takes an image and detect the peaks usingthe local maximum filter.
     Returns a boolean mask of the peaks (i.e. 1 when
     the pixel's value is the neighborhood maximum, 0 otherwise)
+    The image can also be a stack of 2D fields, in which case the neighborhood
+    must have the same number of dimensions as the image.
     """
 
     # define an 8-connected neighborhood
@@ -687,16 +1403,276 @@ def detect_peaks(image, neighborhood = [[0,1,0],[1,1,1],[0,1,0]]):
 
     #we obtain the final mask, containing only peaks,
     #by removing the background from the local_max mask
-    detected_peaks = local_max - eroded_background
+    detected_peaks = local_max & ~eroded_background
 
     return detected_peaks
 
 
+def stack_structure(structure, ndim):
+    """
+    Embeds a 2D structure in an array with ndim dimensions, so that there is
+    no connectivity along the leading (stacking) dimensions.
+
+    Parameters
+    ----------
+    structure : 2D numpy array
+      Structure or footprint for the horizontal dimensions
+    ndim : int
+      Number of dimensions of the stack
+
+    Returns
+    -------
+    stack_struct : numpy.ndarray
+      Structure with shape [1, ..., 1, nx, ny]
+    """
+    structure = np.asarray(structure)
+    return structure.reshape((1,) * (ndim - 2) + structure.shape)
+
+
+def object_properties(labels, field, nobj=None, legacy_com=False):
+    """
+    Computes size, sum, center of mass, bounding box and maximum of all
+    labeled objects in a single scan of the label array. The pixels of all
+    objects are sorted by label once and reduced for each object.
+
+    Parameters
+    ----------
+    labels : numpy.ndarray
+      Labels, 0 is background. Any number of dimensions.
+    field : numpy.ndarray
+      Field with same shape as labels, used for sums, centers of mass and
+      maxima
+    nobj : int, optional
+      Number of objects, labels 1 to nobj are returned. Default is the largest
+      label.
+    legacy_com : bool, optional
+      If True, the centers of mass are only returned for range(1, num), where
+      num is the number of unique values in labels including the background.
+      This reproduces the old center_of_mass call in identify_clouds and
+      calc_rdf.
+
+    Returns
+    -------
+    obj_size : numpy.ndarray
+      Number of pixels of each object
+    obj_sum : numpy.ndarray
+      Summed value of field for each object
+    cof : numpy.ndarray
+      Centers of mass with dimensions [object, labels.ndim]
+    bbox : numpy.ndarray
+      Bounding box of each object with dimensions [object, labels.ndim, 2],
+      start and stop (exclusive) indices in each dimension
+    obj_max : numpy.ndarray
+      Maximum value of field for each object
+    """
+    field = np.asarray(field, dtype=float)
+    labels = np.asarray(labels)
+    if nobj is None:
+        nobj = int(labels.max()) if labels.size > 0 else 0
+
+    obj_size = np.zeros(nobj)
+    obj_sum = np.zeros(nobj)
+    cof = np.empty((nobj, labels.ndim)) * np.nan
+    bbox = np.zeros((nobj, labels.ndim, 2), dtype=int)
+    obj_max = np.empty(nobj) * np.nan
+
+    # Pixels of all objects, sorted by label, raster order within each object
+    idx = np.flatnonzero(labels)
+    obj = labels.ravel()[idx]
+    order = np.argsort(obj, kind='mergesort')
+    idx = idx[order]
+    obj = obj[order]
+
+    if obj.size > 0:
+        starts = np.flatnonzero(np.concatenate([[True], obj[1:] != obj[:-1]]))
+        iobj = obj[starts] - 1
+        weights = field.ravel()[idx]
+
+        obj_size[iobj] = np.diff(np.append(starts, obj.size))
+        obj_sum[iobj] = np.add.reduceat(weights, starts)
+        obj_max[iobj] = np.maximum.reduceat(weights, starts)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            for d, coord in enumerate(np.unravel_index(idx, labels.shape)):
+                cof[iobj, d] = (np.add.reduceat(weights * coord, starts) /
+                                obj_sum[iobj])
+                bbox[iobj, d, 0] = np.minimum.reduceat(coord, starts)
+                bbox[iobj, d, 1] = np.maximum.reduceat(coord, starts) + 1
+
+    if legacy_com:
+        num = np.count_nonzero(obj_size) + int(obj.size < labels.size)
+        cof = cof[:max(num - 1, 0)]
+
+    return obj_size, obj_sum, cof, bbox, obj_max
+
+
+def separate_clouds(field, cld_labels, seeds, structure):
+    """
+    Separates the clouds with the watershed algorithm. Clouds with only one
+    local maximum need no separation and get the label of their seed
+    directly, the watershed is only applied to clouds with several local
+    maxima. For fields without exactly equal values at the local maxima the
+    labels are identical to a watershed on the full field.
+
+    Parameters
+    ----------
+    field : numpy.ndarray
+      Field from which clouds are identified
+    cld_labels : numpy.ndarray
+      Labels of the non-separated clouds
+    seeds : numpy.ndarray
+      Labels of the local maxima
+    structure : numpy.ndarray
+      Connectivity of the labels
+
+    Returns
+    -------
+    labels : numpy.ndarray
+      Labels of the separated clouds, the label of each cloud is the label of
+      its seed
+    """
+    nseed = seeds.max()
+
+    # Non-separated cloud of each seed, seeds outside of clouds are ignored
+    seed_idx = np.flatnonzero(seeds)
+    seed_cld = np.zeros(nseed + 1, dtype=int)
+    seed_cld[seeds.ravel()[seed_idx]] = cld_labels.ravel()[seed_idx]
+    nseed_cld = np.bincount(seed_cld[1:], minlength=cld_labels.max() + 1)
+    nseed_cld[0] = 0
+
+    # Clouds with one seed get the seed label, clouds without seeds are not
+    # reached by the watershed
+    cld_seed = np.zeros(nseed_cld.shape[0], dtype=np.int32)
+    cld_seed[seed_cld[1:]] = np.arange(1, nseed + 1)
+    cld_seed[nseed_cld != 1] = 0
+    labels = cld_seed[cld_labels]
+
+    # Watershed for clouds with several seeds
+    multi_mask = nseed_cld[cld_labels] > 1
+    if np.any(multi_mask):
+        tmp = morphology.watershed(-field, seeds * multi_mask,
+                                   mask=multi_mask, connectivity=structure)
+        labels[multi_mask] = tmp[multi_mask]
+    return labels
+
+
+def identify_clouds_stack(field, thresh, opt_field=None, opt_thresh=None,
+                          water=False, dx=2800., rho=None,
+                          neighborhood=[[0, 1, 0], [1, 1, 1], [0, 1, 0]],
+                          legacy_com=False):
+    """
+    Identifies the clouds in a stack of 2D fields, e.g. [member, x, y] or
+    [time, member, x, y], at once. The 2D slices are labeled independently,
+    but the labels are unique in the entire stack and increase with the slice
+    index.
+
+    Parameters
+    ----------
+    field : numpy.ndarray
+      Stack of fields from which clouds are identified. The last two
+      dimensions are x and y.
+    thresh : float
+      Threshold for field
+    opt_field : numpy.ndarray, optional
+      Optional field used for creating a binary mask
+    opt_thresh : float, optional
+      Threshold for opt_field
+    water : bool or str, optional
+      If true, watershed algorithm is applied to identify clouds. If 'both',
+      the regular and the separated clouds are identified from the same
+      thresholding and labeling step.
+    dx : float, optional
+      Grid spacing [m]
+    rho : numpy.ndarray, optional
+      If given, the cloud sums and centers of mass are computed from field *
+      rho
+    neighborhood : int or 2D numpy array
+      Defines the search perimeter for cloud separation. Only valid of water is
+      True
+    legacy_com : bool, optional
+      Old center of mass indexing, see object_properties. Only meaningful for
+      a single 2D field.
+
+    Returns
+    -------
+    labels : numpy.ndarray
+      Labels with same shape as field
+    cld_size : numpy.ndarray
+      Cloud sizes [m^2]
+    cld_sum : numpy.ndarray
+      Summed value of field for each cloud
+    cof : numpy.ndarray
+      Centers of mass in x and y of each cloud, dimensions [cloud, 2]
+    cld_slice : numpy.ndarray
+      Flat index of the 2D slice of each cloud, e.g. ie for [member, x, y] or
+      it * n_member + ie for [time, member, x, y]
+    If water is 'both', a tuple with the above for the regular clouds and a
+    tuple with the above for the separated clouds are returned.
+
+    """
+    field = np.asarray(field, dtype=float)
+    ndim = field.ndim
+
+    # Get binary field, 1s where there are clouds
+    binfield = field > thresh
+    if opt_field is not None:
+        binfield &= np.asarray(opt_field) > opt_thresh
+
+    # The 2D cross, no connectivity along the stacking dimensions
+    structure = np.zeros((3,) * ndim, dtype=bool)
+    structure[(1,) * (ndim - 2)] = [[0, 1, 0], [1, 1, 1], [0, 1, 0]]
+
+    # Find objects
+    cld_labels, ncld = measurements.label(binfield, structure=structure)
+
+    # Labels, seeds and number of objects of each requested cloud type
+    labelings = []
+    if water == 'both' or not water:  # Regular algorithm
+        labelings.append((cld_labels, cld_labels, ncld))
+
+    if water: # Apply watershed algorithm
+        if type(neighborhood) is int:   # Convert integer to matrix
+            neighborhood = np.ones((neighborhood, neighborhood))
+        neighborhood = stack_structure(neighborhood, ndim)
+
+        # Get local maxima
+        lmax = detect_peaks(field*binfield, neighborhood=neighborhood)
+        # Do the watershed segmentation
+        # Get individual labels for local maxima
+        seeds, nseed = measurements.label(lmax, structure=structure)
+        labels = separate_clouds(field, cld_labels, seeds, structure)
+        labelings.append((labels, seeds, nseed))
+
+    # Weighted field for sums and centers of mass, do not modify the input
+    if rho is not None:
+        field = field * rho
+
+    results = []
+    for labels, seeds, nobj in labelings:
+        # Sizes, sums and centers of mass from one pass over the cloud pixels
+        cld_size, cld_sum, cof, bbox, cld_max = \
+            object_properties(labels, field, nobj=nobj, legacy_com=legacy_com)
+        cof = cof[:, -2:]
+
+        # Slice index of each cloud from its seed pixels
+        cld_slice = np.zeros(nobj, dtype=int)
+        seed_idx = np.flatnonzero(seeds)
+        cld_slice[seeds.ravel()[seed_idx] - 1] = \
+            seed_idx // (field.shape[-2] * field.shape[-1])
+
+        results.append((labels, cld_size * dx * dx, cld_sum, cof, cld_slice))
+
+    if water == 'both':
+        return results[0], results[1]
+    return results[0]
+
+
 def identify_clouds(field, thresh, opt_field = None, opt_thresh = None,
                     water = False, dx = 2800., rho = None,
                     neighborhood=[[0, 1, 0], [1, 1, 1], [0, 1, 0]],
                     return_com=False):
     """
+    Identifies the clouds in one 2D field, see identify_clouds_stack.
+
     Parameters
     ----------
     field : numpy.ndarray
@@ -731,43 +1707,266 @@ def identify_clouds(field, thresh, opt_field = None, opt_thresh = None,
 
     """
 
-    # Get binary field, 1s where there are clouds
-    binfield = field > thresh
-    if opt_field is not None:
-        binfield *= opt_field > opt_thresh
+    labels, cld_size, cld_sum, cof, cld_slice = \
+        identify_clouds_stack(field, thresh, opt_field=opt_field,
+                              opt_thresh=opt_thresh, water=water, dx=dx,
+                              rho=rho, neighborhood=neighborhood,
+                              legacy_com=True)
 
-    if water: # Apply watershed algorithm
-        if type(neighborhood) is int:   # Convert integer to matrix
-            neighborhood = np.ones((neighborhood, neighborhood))
+    if return_com is not True:
+        return labels, cld_size, cld_sum
+    else:
+        return labels, cld_size, cld_sum, cof
 
-        # Get local maxima
-        lmax = detect_peaks(field*binfield, neighborhood=neighborhood)
-        # Do the watershed segmentation
-        # Get individual labels for local maxima
-        lmax_labels, ncld = measurements.label(lmax)
-        labels = morphology.watershed(-field, lmax_labels, mask = binfield)
 
-    else:  # Regular algorithm
-        # Find objects
-        structure = [[0,1,0],[1,1,1],[0,1,0]]
-        labels, ncld = measurements.label(binfield, structure = structure)
-        print('Regular ncld = %i' % (ncld))
+# Columns of the cloud catalogue and their types, one row per cloud object
+catalogue_columns = [
+    ('date', 'i2'),       # Date index
+    ('time', 'i2'),       # Time index
+    ('member', 'i2'),     # Ensemble index
+    ('sep', 'i1'),        # 1 for separated clouds
+    ('size', 'i4'),       # Size in grid points
+    ('sum', 'f8'),        # Sum of field (* rho)
+    ('com_x', 'f8'),      # Center of mass of field (* rho)
+    ('com_y', 'f8'),
+    ('centroid_x', 'f8'),  # Center of mass of field, used for RDFs
+    ('centroid_y', 'f8'),
+]
 
-    # Get sizes and sums
-    cld_size = measurements.sum(binfield, labels, range(1, ncld+1))
-    if rho is not None:
-        field *= rho
-    cld_sum = measurements.sum(field, labels, range(1, ncld+1))
 
-    if return_com is not True:
-        return labels, cld_size * dx * dx, cld_sum
+def get_cloud_catalogue(inargs, group, var, lvl=None, radar_mask_type=False):
+    """
+    Returns the cloud catalogue for the given parameters. The catalogue
+    contains the regular and the separated clouds of all dates, times and
+    members. It is created once for each parameter set from the preloaded
+    fields and reused by all scripts.
+
+    Parameters
+    ----------
+    inargs : argparse object
+      Argparse object with all input arguments
+    group : str
+      Which dataset. Options are [ens, det, obs]
+    var : str
+      'm' for mass flux clouds or 'PREC_ACCUM' for precipitation clouds
+    lvl : int
+      Vertical level for mass flux clouds
+    radar_mask_type : bool or str
+      If given, radar masked points of PREC_ACCUM are set to zero. Options
+      are [total, day, hour]
 
+    Returns
+    -------
+    catalogue : NetCDF Dataset object
+      Opened for reading
+    """
+    if inargs.footprint == 0:   # Use default cross
+        footprint = [[0, 1, 0], [1, 1, 1], [0, 1, 0]]
     else:
-        num = np.unique(labels).shape[0]  # Number of identified objects
-        # Get centers of mass for each object
-        cof = measurements.center_of_mass(field, labels, range(1, num))
-        cof = np.array(cof)
-        return labels, cld_size * dx * dx, cld_sum, cof
+        footprint = inargs.footprint
+
+    config = load_config(inargs)
+    cat_params = {
+        'args': {
+            'var': var,
+            'group': group,
+            'date_start': inargs.date_start,
+            'date_end': inargs.date_end,
+            'time_start': inargs.time_start,
+            'time_end': inargs.time_end,
+            'time_inc': inargs.time_inc,
+            'nens': inargs.nens if group == 'ens' else 1,
+            'lvl': lvl if var == 'm' else None,
+            'radar_mask': radar_mask_type if var == 'PREC_ACCUM' else False,
+            'thresh': inargs.thresh,
+            'footprint': footprint,
+        },
+        'domain': config['domain'],
+        'storage': dict([(key, config['storage'][key]) for key in
+                         ['dtype', 'pack_range']]),
+        'version': 'cloud_catalogue-1',
+    }
+    cat_key = get_params_key(cat_params)
+    cat_dir = get_config(inargs, 'paths', 'preproc_data') + 'cloud_catalogue/'
+    if os.path.exists(cat_dir) is False:
+        os.makedirs(cat_dir)
+    cat_fn = cat_dir + cat_params['version'] + '_' + cat_key + '.nc'
+    update_pp_index(cat_dir, cat_key, cat_params)
+
+    # Use the existing catalogue if it is complete
+    if os.path.isfile(cat_fn) and inargs.recompute is False:
+        catalogue = Dataset(cat_fn, 'r')
+        if getattr(catalogue, 'complete', 0) == 1:
+            print('Found cloud catalogue: ' + cat_fn)
+            return catalogue
+        catalogue.close()
+
+    print('Create cloud catalogue: ' + cat_fn)
+    if var == 'm':
+        raw_data = load_raw_data(inargs, ['W', 'QC', 'QI', 'QS', 'RHO'],
+                                 group, lvl=lvl)
+    else:
+        raw_data = load_raw_data(inargs, 'PREC_ACCUM', group,
+                                 radar_mask_type=radar_mask_type)
+    create_cloud_catalogue(inargs, raw_data, cat_fn, var, footprint,
+                           radar_mask_type)
+    raw_data.close()
+    return Dataset(cat_fn, 'r')
+
+
+def create_cloud_catalogue(inargs, raw_data, cat_fn, var, footprint,
+                           radar_mask_type=False):
+    """
+    Identifies the regular and separated clouds in the preloaded fields and
+    writes their properties in the catalogue file. The objects are ordered by
+    date, cloud type, time and member, the first object and the number of
+    objects of each slice are stored in obj_start and obj_count.
+
+    Parameters
+    ----------
+    inargs : argparse object
+      Argparse object with all input arguments
+    raw_data : NetCDF dataset object
+      Preloaded fields
+    cat_fn : str
+      File name of the catalogue
+    var : str
+      'm' or 'PREC_ACCUM'
+    footprint : int or 2D list
+      Neighborhood for cloud separation
+    radar_mask_type : bool or str
+      If given, radar masked points are set to zero
+    """
+    ndate = raw_data.dimensions['date'].size
+    ntime = raw_data.dimensions['time'].size
+    nens = raw_data.dimensions['ens_no'].size
+
+    catalogue = Dataset(cat_fn, 'w', format='NETCDF4')
+    catalogue.log = create_log_str(inargs, 'Preprocessing')
+    catalogue.createDimension('object', None)
+    for dim_name, dim_len in [('date', ndate), ('sep', 2), ('time', ntime),
+                              ('ens_no', nens)]:
+        catalogue.createDimension(dim_name, dim_len)
+    for col_name, col_type in catalogue_columns:
+        catalogue.createVariable(col_name, col_type, 'object',
+                                 zlib=get_config(inargs, 'storage', 'zlib'),
+                                 complevel=get_config(inargs, 'storage',
+                                                      'complevel'))
+    obj_start = catalogue.createVariable('obj_start', 'i8',
+                                         ['date', 'sep', 'time', 'ens_no'])
+    obj_count = catalogue.createVariable('obj_count', 'i4',
+                                         ['date', 'sep', 'time', 'ens_no'])
+
+    nobj = 0
+    for idate in range(ndate):
+        columns = [dict((col_name, []) for col_name, col_type in
+                        catalogue_columns) for sep in [0, 1]]
+        for ie in range(nens):
+            # Identify the clouds for all times at once, stack is [time, x, y]
+            if var == 'm':
+                field = raw_data.variables['W'][idate, :, ie]
+                opt_field = (raw_data.variables['QC'][idate, :, ie] +
+                             raw_data.variables['QI'][idate, :, ie] +
+                             raw_data.variables['QS'][idate, :, ie])
+                rho = raw_data.variables['RHO'][idate, :, ie]
+                opt_thresh = 0.
+            else:
+                field = raw_data.variables['PREC_ACCUM'][idate, :, ie]
+                opt_field = None
+                rho = None
+                opt_thresh = None
+                if radar_mask_type is not False:
+                    # set all masked points to zero
+                    mask_var = raw_data.variables['mask_' + radar_mask_type]
+                    field[mask_var[idate].astype(bool)] = 0
+
+            # Sizes in grid points, dx = 1
+            results = identify_clouds_stack(field, inargs.thresh,
+                                            opt_field=opt_field, water='both',
+                                            rho=rho, dx=1.,
+                                            neighborhood=footprint,
+                                            opt_thresh=opt_thresh)
+            for sep, result in enumerate(results):
+                labels, cld_size, cld_sum, com, cld_time = result
+                if rho is not None:
+                    centroid = object_properties(labels, field,
+                                                 nobj=cld_size.shape[0])[2]
+                    centroid = centroid[:, -2:]
+                else:
+                    centroid = com
+                tmp = {
+                    'date': np.ones_like(cld_time) * idate,
+                    'time': cld_time,
+                    'member': np.ones_like(cld_time) * ie,
+                    'sep': np.ones_like(cld_time) * sep,
+                    'size': np.round(cld_size).astype(int),
+                    'sum': cld_sum,
+                    'com_x': com[:, 0],
+                    'com_y': com[:, 1],
+                    'centroid_x': centroid[:, 0],
+                    'centroid_y': centroid[:, 1],
+                }
+                for col_name in tmp:
+                    columns[sep][col_name].append(tmp[col_name])
+
+        # Write the objects ordered by time and member
+        for sep in [0, 1]:
+            col = dict((col_name, np.concatenate(col_list)) for
+                       col_name, col_list in columns[sep].items())
+            order = np.lexsort((col['member'], col['time']))
+            count = np.bincount(col['time'] * nens + col['member'],
+                                minlength=ntime * nens)
+            start = nobj + np.cumsum(count) - count
+            obj_start[idate, sep] = start.reshape(ntime, nens)
+            obj_count[idate, sep] = count.reshape(ntime, nens)
+            if order.shape[0] > 0:
+                for col_name, col_type in catalogue_columns:
+                    catalogue.variables[col_name][nobj:nobj +
+                                                  order.shape[0]] = \
+                        col[col_name][order]
+            nobj += order.shape[0]
+
+    catalogue.complete = 1
+    catalogue.close()
+
+
+def read_cloud_catalogue(catalogue, idate, sep, it=None):
+    """
+    Reads the objects of one date and cloud type from the cloud catalogue.
+
+    Parameters
+    ----------
+    catalogue : NetCDF Dataset object
+      Cloud catalogue from get_cloud_catalogue
+    idate : int
+      Date index
+    sep : bool
+      If True, the separated clouds are returned
+    it : int, optional
+      If given, only the objects of this time index are returned
+
+    Returns
+    -------
+    objects : dict
+      Dictionary with an array for each column of the catalogue
+    """
+    start = catalogue.variables['obj_start'][idate, int(sep)]
+    count = catalogue.variables['obj_count'][idate, int(sep)]
+    if it is not None:
+        start = start[it]
+        count = count[it]
+
+    # The objects are stored contiguously
+    i_start = int(np.min(start))
+    i_stop = int(np.max(start + count))
+    objects = {}
+    for col_name, col_type in catalogue_columns:
+        if i_stop > i_start:
+            objects[col_name] = np.asarray(
+                catalogue.variables[col_name][i_start:i_stop])
+        else:
+            objects[col_name] = np.zeros(0, dtype=col_type)
+    return objects
 
 
 def calc_rdf(labels, field, normalize=True, dx=2800., r_max=30, dr=1, mask=None):
@@ -789,6 +1988,8 @@ def calc_rdf(labels, field, normalize=True, dx=2800., r_max=30, dr=1, mask=None)
       Maximum search radius for RDF algorithm (in grid pts)
     dr : int, optional
       Search step (in grid pts)
+    mask : numpy.ndarray, optional
+      Precomputed eroded mask, see pair_correlation_2d
       
     Returns
     -------
@@ -798,22 +1999,94 @@ def calc_rdf(labels, field, normalize=True, dx=2800., r_max=30, dr=1, mask=None)
       Distance
     """
 
-    num = np.unique(labels).shape[0]   # Number of identified objects
     # Get centers of mass for each object
-    cof = measurements.center_of_mass(field, labels, range(1,num))
-    cof = np.array(cof)
+    cof = object_properties(labels, field, legacy_com=True)[2]
+
+    return calc_rdf_cof(cof, field.shape, normalize=normalize, dx=dx,
+                        r_max=r_max, dr=dr, mask=mask)
+
 
+def calc_rdf_cof(cof, shape, normalize=True, dx=2800., r_max=30, dr=1,
+                 mask=None):
+    """
+    Computes radial distribution function from the centers of mass of the
+    objects, see calc_rdf.
+
+    Parameters
+    ----------
+    cof : numpy.ndarray
+      Centers of mass with dimensions [object, 2]
+    shape : tuple
+      Shape of the field [x, y]
+    normalize : bool, optional
+      If True normalize RDF
+    dx : float, optional
+      Grid spacing [m], used for r
+    r_max : int, optional
+      Maximum search radius for RDF algorithm (in grid pts)
+    dr : int, optional
+      Search step (in grid pts)
+    mask : numpy.ndarray, optional
+      Precomputed eroded mask, see pair_correlation_2d
+
+    Returns
+    -------
+    g: numpy.ndarray
+      (Normalized) RDF
+    r : numpy.ndarray
+      Distance
+    """
     # If no centers of mass are found, an enpty array is passed
     if cof.shape[0] == 0:   # Accout for empty arrays
         cof = np.empty((0,2))
 
     g, r, tmp = pair_correlation_2d(cof[:, 0], cof[:, 1],
-                                    [field.shape[0], field.shape[1]],
+                                    [shape[0], shape[1]],
                                     r_max, dr, normalize=normalize, mask=mask)
 
     return g, r*dx
 
 
+# Cache for eroded rdf masks, keyed by (mask hash, r_max)
+rdf_mask_cache = {}
+
+
+def calc_rdf_mask(mask, r_max):
+    """
+    Erodes a mask by r_max, so that the circles around all reference
+    particles for the RDF lie inside the valid region. Points outside the
+    domain count as masked. The convolution with the circular kernel is done
+    with FFTs and the result is cached, so it is computed only once for each
+    mask, e.g. for all ensemble members of one hour.
+
+    Parameters
+    ----------
+    mask : numpy.ndarray
+      2D mask, nonzero where masked
+    r_max : int
+      Maximum search radius for RDF algorithm (in grid pts)
+
+    Returns
+    -------
+    rdf_mask : numpy.ndarray
+      2D boolean array, True where particles can be reference particles
+    """
+    mask = np.ascontiguousarray(mask != 0)
+    key = (hashlib.sha1(mask.view(np.uint8)).hexdigest(), mask.shape, r_max)
+    if key not in rdf_mask_cache:
+        kernel_size = r_max * 2 + 1
+        y_tmp, x_tmp = np.ogrid[-r_max:kernel_size - r_max,
+                       -r_max:kernel_size - r_max]
+        kernel = x_tmp * x_tmp + y_tmp * y_tmp <= r_max * r_max
+        # Pad with ones, this is the same as boundary fill with 1
+        padded = np.pad(mask.astype(float), r_max, mode='constant',
+                        constant_values=1)
+        conv = fftconvolve(padded, kernel.astype(float), mode='valid')
+        # The FFT result is not exactly integer
+        rdf_mask_cache[key] = conv < 0.5
+    return rdf_mask_cache[key]
+
+
 def pair_correlation_2d(x, y, S, r_max, dr, normalize=True, mask=None):
     """
     Need new doc string
@@ -834,6 +2107,9 @@ def pair_correlation_2d(x, y, S, r_max, dr, normalize=True, mask=None):
         S               length of each side of the square region of the plane
         r_max            outer diameter of largest annulus
         dr              increment for increasing radius of annulus
+        mask            optional eroded mask, 1 where a circle of radius r_max
+                        around a reference particle lies entirely inside the
+                        valid region. Can be shared across fields.
     Returns a tuple: (g, radii, interior_indices)
         g(r)            a numpy array containing the correlation function g(r)
         radii           a numpy array containing the radii of the
@@ -859,41 +2135,46 @@ def pair_correlation_2d(x, y, S, r_max, dr, normalize=True, mask=None):
         bools4 = y < (Sy - r_max)
         interior_indices, = np.where(bools1 * bools2 * bools3 * bools4)
     else:
-        # Get closes indices for parcels in a pretty non-pythonic way
-        # and check whether it is inside convolved mask
-        x_round = np.round(x)
-        y_round = np.round(y)
-        interior_indices = []
-        for i in range(x_round.shape[0]):
-            if mask[int(x_round[i]), int(y_round[i])] == 1:
-                interior_indices.append(i)
+        # Get closest indices for parcels and check whether they are inside
+        # the eroded mask
+        x_round = np.round(x).astype(int)
+        y_round = np.round(y).astype(int)
+        interior_indices, = np.where(np.asarray(mask)[x_round, y_round] == 1)
 
     num_interior_particles = len(interior_indices)
 
     edges = np.arange(0., r_max + dr, dr)   # Was originally 1.1?
     num_increments = len(edges) - 1
-    g = np.zeros([num_interior_particles, num_increments])
-    radii = np.zeros(num_increments)
     number_density = float(len(x)) / float(Sx*Sy)
 
-    # Compute pairwise correlation for each interior particle
-    for p in range(num_interior_particles):
-        index = interior_indices[p]
-        d = np.sqrt((x[index] - x)**2 + (y[index] - y)**2)
-        d[index] = 2 * r_max   # Because sqrt(0)
-
-        result, bins = np.histogram(d, bins=edges, normed=False)
-        if normalize:
-            result = result/number_density
-        g[p, :] = result
+    # Find all pairs within the largest radius with a KD-tree. The search
+    # radius is slightly enlarged, the distances are recomputed below and
+    # binned with the same edges. Each pair counts once for each of its
+    # particles which is an interior particle.
+    d_all = np.zeros(0)
+    if num_interior_particles > 0:
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        tree = cKDTree(np.column_stack((x, y)))
+        pairs = tree.query_pairs(edges[-1] * (1. + 1e-8) + 1e-8,
+                                 output_type='ndarray').reshape(-1, 2)
+        interior = np.zeros(len(x), dtype=bool)
+        interior[interior_indices] = True
+        d = np.sqrt((x[pairs[:, 0]] - x[pairs[:, 1]])**2 +
+                    (y[pairs[:, 0]] - y[pairs[:, 1]])**2)
+        d_all = np.concatenate((d[interior[pairs[:, 0]]],
+                                d[interior[pairs[:, 1]]]))
+
+    # Single histogram for all interior particles
+    result = np.histogram(d_all, bins=edges)[0].astype(float)
+    if normalize:
+        result = result / number_density
 
     # Average g(r) for all interior particles and compute radii
-    g_average = np.zeros(num_increments)
-    for i in range(num_increments):
-        radii[i] = (edges[i] + edges[i+1]) / 2.
-        rOuter = edges[i + 1]
-        rInner = edges[i]
-        g_average[i] = np.mean(g[:, i]) / (np.pi * (rOuter**2 - rInner**2))
+    radii = (edges[:-1] + edges[1:]) / 2.
+    with np.errstate(invalid='ignore', divide='ignore'):
+        g_average = (result / num_interior_particles /
+                     (np.pi * (edges[1:]**2 - edges[:-1]**2)))
 
     return g_average, radii, interior_indices
 
@@ -93,12 +93,21 @@ if __name__ == '__main__':
                         type=str,
                         default='',
                         help='Custom plot name.')
+    parser.add_argument('--pp_name',
+                        type=str,
+                        default='',
+                        help='Custom name for preprocessed file.')
     parser.add_argument('--recompute',
                         dest='recompute',
                         action='store_true',
                         help='If True, recompute pre-processed file.')
     parser.set_defaults(recompute=False)
 
+    # Arguments which change the pre-processed file
+    parser.set_defaults(pp_args=['date_start', 'date_end', 'time_start',
+                                 'time_end', 'time_inc', 'nens', ???],
+                        pp_version='???-1')
+
     args = parser.parse_args()
 
     main(args)
\ No newline at end of file
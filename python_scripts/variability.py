@@ -6,12 +6,15 @@ Description:  Compute variance and mean of coarse grained fields
 """
 
 import argparse
+import os
+from multiprocessing import Pool
 from netCDF4 import Dataset
 from datetime import datetime, timedelta
-from helpers import pp_exists, get_pp_fn, load_raw_data, make_datelist, \
-                    identify_clouds, get_config, create_log_str, \
-                    read_netcdf_dataset, save_fig_and_log, get_composite_str, \
-                    fit_curve
+from helpers import get_pp_fn, load_raw_data, make_datelist, \
+                    get_cloud_catalogue, read_cloud_catalogue, get_config, \
+                    create_log_str, read_netcdf_dataset, save_fig_and_log, \
+                    get_composite_str, fit_curve, create_storage_variable, \
+                    pp_complete, open_pp_file
 import matplotlib.pyplot as plt
 import numpy as np
 
@@ -23,6 +26,13 @@ import numpy as np
 def compute_variance(inargs):
     """
     Main analysis routine to coarse grain fields and compute variances.
+
+    If inargs.workers > 1, the (date, time) steps are distributed over a pool
+    of processes. Each worker reads its clouds from the cloud catalogue and
+    its fields from the preloaded raw data file and returns the arrays for
+    each step, which are written to the pp file in the same order as in the
+    serial case. If the computation fails, the workers are terminated and the
+    pp file is closed, so that the computation can be resumed.
     
     Parameters
     ----------
@@ -32,64 +42,310 @@ def compute_variance(inargs):
 
     """
 
-    # Some preliminaries
-    dx = float(get_config(inargs, 'domain', 'dx'))
-
-    # Make the pp NetCDF file
-    rootgroup = create_netcdf(inargs)
-    rootgroup.variables['cond_m_hist'][:] = 0
-
-    # Load the raw_data
+    # Clouds from the cloud catalogue, the raw data is only needed for the
+    # heating rates
     if inargs.var == 'm':   # Load data for mass flux calculation
-        raw_data = load_raw_data(inargs, ['W', 'QC', 'QI', 'QS', 'RHO',
-                                          'TTENS_MPHY'], 'ens', lvl=inargs.lvl)
+        catalogue = get_cloud_catalogue(inargs, 'ens', 'm', lvl=inargs.lvl)
+        raw_data = load_raw_data(inargs, ['TTENS_MPHY'], 'ens', lvl=inargs.lvl)
     elif inargs.var == 'prec':   # Load data for precipitation calculation
-        raw_data = load_raw_data(inargs, ['PREC_ACCUM'], 'ens')
+        catalogue = get_cloud_catalogue(inargs, 'ens', 'PREC_ACCUM')
+        raw_data = None
     else:
         raise Exception('Wrong var! ' + inargs.var)
 
-    # Loop over each time
-    for idate, date in enumerate(make_datelist(inargs)):
-        print('Computing variance for ' + date)
-        for it in range(rootgroup.dimensions['time'].size):
-            # Loop over ensemble members
-            # Temporarily save the centers of mass and sums
-            com_ens_list = []
-            sum_ens_list = []
-            for ie in range(raw_data.dimensions['ens_no'].size):
-                # Identify the clouds
-                if inargs.var is 'm':
-                    field = raw_data.variables['W'][idate, it, ie]
-                    opt_field = (raw_data.variables['QC'][idate, it, ie] +
-                                 raw_data.variables['QI'][idate, it, ie] +
-                                 raw_data.variables['QS'][idate, it, ie])
-                    rho = raw_data.variables['RHO'][idate, it, ie]
-                    opt_thresh = 0.
+    # Start the workers before the pp file is opened
+    pool = None
+    if inargs.workers > 1:
+        if raw_data is None:
+            raw_fn = None
+        else:
+            raw_fn = raw_data.filepath()
+            raw_data.close()
+        cat_fn = catalogue.filepath()
+        catalogue.close()
+        pool = Pool(inargs.workers, initializer=init_worker,
+                    initargs=(raw_fn, cat_fn))
+
+    # The workers are stopped and the files are closed if anything fails
+    rootgroup = None
+    try:
+        # Make the pp NetCDF file or open it to resume the computation
+        rootgroup = open_pp_file(inargs, create_netcdf)
+        n_list = [int(n) for n in rootgroup.variables['n'][:]]
+        arr_shape = rootgroup.variables['var_M'].shape[2:]
+        hist_shape = rootgroup.variables['cond_m_hist'].shape[2:]
+
+        # List of all steps which are not done yet
+        datelist = make_datelist(inargs)
+        ntime = rootgroup.dimensions['time'].size
+        done = np.zeros((len(datelist), ntime), dtype=int)
+        tmp = np.ma.filled(rootgroup.variables['done'][:], 0)
+        done[:tmp.shape[0]] = tmp
+        steps = [(inargs, idate, it, n_list, arr_shape, hist_shape)
+                 for idate in range(len(datelist))
+                 for it in range(ntime) if done[idate, it] == 0]
+
+        if pool is not None:
+            results = pool.imap(compute_step_worker, steps)
+        else:
+            results = (compute_step(raw_data, catalogue, *step)
+                       for step in steps)
+
+        # Write the results of each time step and mark it as done
+        for i_step, result in enumerate(results):
+            idate, it = steps[i_step][1:3]
+            if i_step == 0 or idate != steps[i_step - 1][1]:
+                print('Computing variance for ' + datelist[idate])
+            write_var_mean(rootgroup, idate, it, result)
+            rootgroup.variables['done'][idate, it] = 1
+            rootgroup.sync()
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+    finally:
+        if pool is not None:
+            # Does nothing if the pool was closed and joined above
+            pool.terminate()
+        else:
+            if raw_data is not None:
+                raw_data.close()
+            catalogue.close()
+        if rootgroup is not None:
+            rootgroup.close()
+
+
+def get_summary_fn(inargs):
+    """
+    Returns the filename of the summary file, which is stored next to the
+    pre-processed file.
+
+    Parameters
+    ----------
+    inargs : argparse object
+      Argparse object with all input arguments
+
+    Returns
+    -------
+    summary_fn : str
+      Filename with path of the summary file
+    """
+    return get_pp_fn(inargs, sufx='_summary.nc')
+
+
+def summary_complete(inargs):
+    """
+    Check whether the summary file exists and is newer than the
+    pre-processed file.
+
+    Parameters
+    ----------
+    inargs : argparse object
+      Argparse object with all input arguments
+
+    Returns
+    -------
+    summary_complete : bool
+      True if summary file is up to date
+    """
+    summary_fn = get_summary_fn(inargs)
+    pp_fn = get_pp_fn(inargs)
+    return (os.path.isfile(summary_fn) and
+            os.path.getmtime(summary_fn) >= os.path.getmtime(pp_fn))
+
+
+def create_summary(inargs):
+    """
+    Computes the statistics of all diurnal plot types for all scales and the
+    data for plot_CC06b_fig9 from the pre-processed file and writes them to
+    the summary file. The plotting routines then only read the summary file.
+    The file is written under a temporary name and renamed when complete.
+
+    Parameters
+    ----------
+    inargs : argparse object
+      Argparse object with all input arguments
+
+    """
+
+    rootgroup = read_netcdf_dataset(inargs)
+    summary_fn = get_summary_fn(inargs)
+    tmp_fn = summary_fn + '.tmp'
+
+    sumgroup = Dataset(tmp_fn, 'w', format='NETCDF4')
+    sumgroup.log = rootgroup.log
+    for dim_name in ['date', 'time', 'n']:
+        dim_val = rootgroup.variables[dim_name][:]
+        sumgroup.createDimension(dim_name, dim_val.shape[0])
+        tmp_var = sumgroup.createVariable(dim_name, 'f8', dim_name)
+        tmp_var[:] = dim_val
 
+    for plot_type in diurnal_vars:
+        for stat, stat_dims in diurnal_stats.items():
+            if stat.startswith('num'):
+                dtype = 'i8'
+            else:
+                dtype = 'f8'
+            sumgroup.createVariable(plot_type + '_' + stat, dtype, stat_dims)
+
+    for i_n in range(rootgroup.dimensions['n'].size):
+        print('Computing summary for scale index ' + str(i_n))
+        # The summary always uses the mean m of the pp file, a fixed
+        # diurnal_ext_m is only applied when plotting
+        stats = comp_diurnal_stats(inargs, rootgroup, i_n,
+                                   list(diurnal_vars.keys()), ext_m=None)
+        for plot_type, plot_stats in stats.items():
+            for stat, stat_dims in diurnal_stats.items():
+                var = sumgroup.variables[plot_type + '_' + stat]
+                if stat_dims[0] == 'date':
+                    var[:, i_n] = plot_stats[stat]
                 else:
-                    field = raw_data.variables['PREC_ACCUM'][idate, it, ie]
-                    opt_field = None
-                    rho = None
-                    opt_thresh = None
-
-                labels, size_list, sum_list, com_list = \
-                    identify_clouds(field, inargs.thresh, opt_field=opt_field,
-                                    water=inargs.sep, rho=rho,
-                                    dx=dx, neighborhood=inargs.footprint,
-                                    return_com=True, opt_thresh=opt_thresh)
-
-                if com_list.shape[0] == 0:   # Accout for empty arrays, Need that?
-                    com_list = np.empty((0,2))
-
-                if inargs.var == 'm':
-                    sum_list = sum_list * dx * dx   # to convert to mass flux
-                com_ens_list.append(com_list)
-                sum_ens_list.append(sum_list)
-
-            # Compute the variances and means
-            comp_var_mean(inargs, idate, it, rootgroup, com_ens_list,
-                          sum_ens_list, raw_data)
+                    var[i_n] = plot_stats[stat]
+
+    x_data, y_data = comp_CC06b_fig9(inargs, rootgroup)
+    sumgroup.createVariable('fig9_x', 'f8', ['n'])[:] = x_data
+    sumgroup.createVariable('fig9_y', 'f8', ['n'])[:] = y_data
+
     rootgroup.close()
+    sumgroup.close()
+    os.rename(tmp_fn, summary_fn)
+
+
+def read_summary_dataset(inargs):
+    """
+    Open summary file and return rootgroup object.
+
+    Parameters
+    ----------
+    inargs : argparse object
+      Argparse object with all input arguments
+
+    Returns
+    -------
+    rootgroup : NetCDF object
+      NetCDF object
+    """
+    return Dataset(get_summary_fn(inargs))
+
+
+def get_ens_clouds(inargs, catalogue, idate, it):
+    """
+    Get the clouds of all ensemble members for one time step from the cloud
+    catalogue.
+
+    Parameters
+    ----------
+    inargs : argparse object
+      Argparse object with all input arguments
+    catalogue : NetCDF dataset object
+      Cloud catalogue from get_cloud_catalogue
+    idate : int
+      Date index
+    it : int
+      Time index
+
+    Returns
+    -------
+    com_ens_list : list
+      list with centers of mass
+    sum_ens_list : list
+      list with object sums
+    """
+    dx = float(get_config(inargs, 'domain', 'dx'))
+
+    objects = read_cloud_catalogue(catalogue, idate, inargs.sep, it)
+    com_list = np.array([objects['com_x'], objects['com_y']]).T
+    sum_list = objects['sum']
+
+    if inargs.var == 'm':
+        sum_list = sum_list * dx * dx   # to convert to mass flux
+
+    # Split into lists for each member
+    com_ens_list = []
+    sum_ens_list = []
+    for ie in range(inargs.nens):
+        com_ens_list.append(com_list[objects['member'] == ie])
+        sum_ens_list.append(sum_list[objects['member'] == ie])
+
+    return com_ens_list, sum_ens_list
+
+
+def compute_step(raw_data, catalogue, inargs, idate, it, n_list, arr_shape,
+                 hist_shape):
+    """
+    Get the clouds and compute variances and means for one time step.
+
+    Parameters
+    ----------
+    raw_data : NetCDF dataset object
+      To load raw data
+    catalogue : NetCDF dataset object
+      Cloud catalogue
+    inargs : argparse object
+      Argparse object with all input arguments
+    idate : int
+      Date index
+    it : int
+      Time index
+    n_list : list
+      Coarsening sizes
+    arr_shape : tuple
+      Shape of output arrays [n, x, y]
+    hist_shape : tuple
+      Shape of conditional histogram
+
+    Returns
+    -------
+    result : dict
+      Arrays to be written to the pp file
+    """
+    com_ens_list, sum_ens_list = get_ens_clouds(inargs, catalogue, idate, it)
+    if inargs.var == 'm':
+        ttens = raw_data.variables['TTENS_MPHY'][idate, it]
+    else:
+        ttens = None
+    return comp_var_mean(inargs, n_list, arr_shape, hist_shape, com_ens_list,
+                         sum_ens_list, ttens)
+
+
+# Raw data file and cloud catalogue opened once by each worker process
+worker_raw_data = None
+worker_catalogue = None
+
+
+def init_worker(raw_fn, cat_fn):
+    """
+    Opens the preloaded raw data file and the cloud catalogue in each worker
+    process.
+
+    Parameters
+    ----------
+    raw_fn : str or None
+      File name of preloaded raw data
+    cat_fn : str
+      File name of the cloud catalogue
+    """
+    global worker_raw_data, worker_catalogue
+    if raw_fn is not None:
+        worker_raw_data = Dataset(raw_fn, 'r')
+    worker_catalogue = Dataset(cat_fn, 'r')
+
+
+def compute_step_worker(step):
+    """
+    Calls compute_step in a worker process.
+
+    Parameters
+    ----------
+    step : tuple
+      Arguments for compute_step without raw_data and catalogue
+
+    Returns
+    -------
+    result : dict
+      Arrays to be written to the pp file
+    """
+    return compute_step(worker_raw_data, worker_catalogue, *step)
 
 
 def create_netcdf(inargs):
@@ -125,9 +381,12 @@ def create_netcdf(inargs):
         'mean_M': ['date', 'time', 'n', 'x', 'y'],
         'mean_N': ['date', 'time', 'n', 'x', 'y'],
         'corr_m_N': ['date', 'time', 'n', 'x', 'y'],
-        'cond_m_hist': ['n', 'cond_bins_mean_m', 'cond_bins_m'],
+        # Conditional histogram of each time step, sum over date and time
+        # for the total histogram
+        'cond_m_hist': ['date', 'time', 'n', 'cond_bins_mean_m',
+                        'cond_bins_m'],
     }
-    if inargs.var is 'm':
+    if inargs.var == 'm':
         variables.update({'var_TTENS': ['date', 'time', 'n', 'x', 'y'],
                           'mean_TTENS': ['date', 'time', 'n', 'x', 'y']})
 
@@ -138,44 +397,56 @@ def create_netcdf(inargs):
     rootgroup.log = create_log_str(inargs, 'Preprocessing')
 
     # Create root dimensions and variables
+    # date is unlimited, so that the file can be extended with new dates
     for dim_name, dim_val in dimensions.items():
-        rootgroup.createDimension(dim_name, dim_val.shape[0])
+        if dim_name == 'date':
+            rootgroup.createDimension(dim_name, None)
+        else:
+            rootgroup.createDimension(dim_name, dim_val.shape[0])
         tmp_var = rootgroup.createVariable(dim_name, 'f8', dim_name)
         tmp_var[:] = dim_val
 
     # Create variables
     for var_name, var_dims in variables.items():
-        tmp_var = rootgroup.createVariable(var_name, 'f8', var_dims)
+        tmp_var = create_storage_variable(inargs, rootgroup, var_name,
+                                          var_dims, dtype_key='pp_dtype')
         # Set all variables to nan by default to save time later
         tmp_var[:] = np.nan
+
+    # Progress variable, 1 for all computed time steps
+    rootgroup.createVariable('done', 'i1', ['date', 'time'], fill_value=0)
     return rootgroup
 
 
-def comp_var_mean(inargs, idate, it, rootgroup, com_ens_list, sum_ens_list,
-                  raw_data):
+def comp_var_mean(inargs, n_list, arr_shape, hist_shape, com_ens_list,
+                  sum_ens_list, ttens=None):
     """
-    Compute variances and means and save in rootgroup object
+    Compute variances and means for one time step
     Parameters
     ----------
     inargs : argparse object
       Argparse object with all input arguments
-    idate : int
-      Date index
-    it : int
-      Time index
-    rootgroup : NetCDF dataset object
-      To save data
+    n_list : list
+      Coarsening sizes
+    arr_shape : tuple
+      Shape of output arrays [n, x, y]
+    hist_shape : tuple
+      Shape of conditional histogram
     com_ens_list : list
       list with centers of mass
     sum_ens_list : list
       list with object sums
-    raw_data : NetCDF dataset object
-      To load raw data
+    ttens : numpy.ndarray
+      Heating rate for each member [ens_no, x, y], only used if var is m
+
+    Returns
+    -------
+    result : dict
+      Arrays for each pp variable
 
     """
 
     # Create temporarty numpy arrays
-    arr_shape = rootgroup.variables['var_M'][idate, it, :, :, :].shape
     tmp_var_M = np.zeros(arr_shape) * np.nan
     tmp_var_N = np.zeros(arr_shape) * np.nan
     tmp_var_m = np.zeros(arr_shape) * np.nan
@@ -184,113 +455,418 @@ def comp_var_mean(inargs, idate, it, rootgroup, com_ens_list, sum_ens_list,
     tmp_mean_m = np.zeros(arr_shape) * np.nan
     tmp_corr_m_N = np.zeros(arr_shape) * np.nan
 
-    tmp_cond_hist = np.zeros(rootgroup.variables['cond_m_hist'].shape)
+    tmp_cond_hist = np.zeros(hist_shape)
 
-    if inargs.var is 'm':
-        # Load raw_data for ttens
-        tmp_ttens = raw_data.variables['TTENS_MPHY'][idate, it]
+    if inargs.var == 'm':
         tmp_var_ttens = np.zeros(arr_shape) * np.nan
         tmp_mean_ttens = np.zeros(arr_shape) * np.nan
+    else:
+        ttens = None
 
     # Loop over different coarsening sizes
-    for i_n, n in enumerate(rootgroup.variables['n']):
-
-        # Get size of coarse arrays
-        nx = int(np.floor(get_config(inargs, 'domain', 'ana_irange') / n))
-        ny = int(np.floor(get_config(inargs, 'domain', 'ana_jrange') / n))
-
-        # Loop over coarse grid boxes
-        for ico in range(nx):
-            for jco in range(ny):
-                # Get limits for each N box
-                n = int(n)
-                xmin = ico * n
-                xmax = (ico + 1) * n
-                ymin = jco * n
-                ymax = (jco + 1) * n
-
-                # Now loop over the ensemble members and save the relevant lists
-                # The terminology follows the mass flux calculations, but
-                # this works for prec as well (hopefully)
-                ens_m_list = []
-                ens_M_list = []
-                ens_N_list = []
-                ens_m_box_list = []   # This actually saves the mean m for each mem
-                if inargs.var is 'm':   # Also compute heating rate sum and var
-                    ens_ttens_list = []
-                for ie, com_list, sum_list in zip(range(inargs.nens),
-                                                  com_ens_list,
-                                                  sum_ens_list):
-
-                    # Get the collapsed clouds for each box
-                    bool_arr = ((com_list[:, 0] >= xmin) &
-                                (com_list[:, 0] < xmax) &
-                                (com_list[:, 1] >= ymin) &
-                                (com_list[:, 1] < ymax))
-
-                    # This is the array with all clouds for this box and member
-                    box_cld_sum = sum_list[bool_arr]
-
-                    # This lists contains all clouds for all members in a box
-                    ens_m_list += list(box_cld_sum)
-
-                    # If the array is empty set M to zero
-                    if len(box_cld_sum) > 0:
-                        ens_M_list.append(np.sum(box_cld_sum))
-                        ens_m_box_list.append(np.mean(box_cld_sum))
-                    else:
-                        ens_M_list.append(0.)
-                        ens_m_box_list.append(0.)
-
-                    # This is the number of clouds
-                    ens_N_list.append(box_cld_sum.shape[0])
-
-                    if inargs.var is 'm':
-                        # This is the MEAN heating rate
-                        ens_ttens_list.append(np.mean(tmp_ttens[ie]
-                                                      [ico * n:(ico + 1) * n,
-                                                       jco * n:(jco + 1) * n]))
-                    # End member loop
-
-                # Now convert the list with all clouds for this box
-                ens_m_list = np.array(ens_m_list)
-
-                # Calculate statistics and save them in ncdf file
-                # Check if x number of members have clouds in them
-
-                if np.sum(np.array(ens_N_list) > 0) >= inargs.minobj:
-                    tmp_var_M[i_n, ico, jco] = np.var(ens_M_list, ddof=1)
-                    tmp_var_N[i_n, ico, jco] = np.var(ens_N_list, ddof=1)
-                    tmp_var_m[i_n, ico, jco] = np.var(ens_m_list, ddof=1)
-                    tmp_mean_M[i_n, ico, jco] = np.mean(ens_M_list)
-                    tmp_mean_N[i_n, ico, jco] = np.mean(ens_N_list)
-                    tmp_mean_m[i_n, ico, jco] = np.mean(ens_m_list)
-                    tmp_corr_m_N[i_n, ico, jco] = np.corrcoef(ens_m_box_list,
-                                                              ens_N_list)[0, 1]
-                    m_bin = np.digitize([np.mean(ens_m_list)],
-                                        np.linspace(0, 2e8, 10)[1:-1],
-                                        right=True)[0]  #TODO: Softcode!
-                    tmp_cond_hist[i_n, m_bin] += np.histogram(ens_m_list, np.linspace(0, 1e9, 50))[0]
-
-                if inargs.var is 'm':
-                    tmp_var_ttens[i_n, ico, jco] = np.var(ens_ttens_list, ddof=1)
-                    tmp_mean_ttens[i_n, ico, jco] = np.mean(ens_ttens_list)
-
-    # Now write to NetCDF
-    rootgroup.variables['var_M'][idate, it] = tmp_var_M
-    rootgroup.variables['var_N'][idate, it] = tmp_var_N
-    rootgroup.variables['var_m'][idate, it] = tmp_var_m
-    rootgroup.variables['mean_M'][idate, it] = tmp_mean_M
-    rootgroup.variables['mean_N'][idate, it] = tmp_mean_N
-    rootgroup.variables['mean_m'][idate, it] = tmp_mean_m
-    rootgroup.variables['corr_m_N'][idate, it] = tmp_corr_m_N
-
-    rootgroup.variables['cond_m_hist'][:] = (rootgroup.variables['cond_m_hist'][:] +
-                                             tmp_cond_hist)
-
-    if inargs.var is 'm':
-        rootgroup.variables['var_TTENS'][idate, it] = tmp_var_ttens
-        rootgroup.variables['mean_TTENS'][idate, it] = tmp_mean_ttens
+    for i_n, nx, ny, box_ens_list, M, N, moments, ttens_box in \
+            iter_coarse_scales(inargs, n_list, com_ens_list, sum_ens_list,
+                               ttens):
+
+        stats = comp_box_stats(inargs, M, N, moments)
+        valid, var_M, var_N, var_m, mean_M, mean_N, mean_m, corr_m_N = stats
+
+        tmp_var_M[i_n, :nx, :ny] = var_M.reshape(nx, ny)
+        tmp_var_N[i_n, :nx, :ny] = var_N.reshape(nx, ny)
+        tmp_var_m[i_n, :nx, :ny] = var_m.reshape(nx, ny)
+        tmp_mean_M[i_n, :nx, :ny] = mean_M.reshape(nx, ny)
+        tmp_mean_N[i_n, :nx, :ny] = mean_N.reshape(nx, ny)
+        tmp_mean_m[i_n, :nx, :ny] = mean_m.reshape(nx, ny)
+        tmp_corr_m_N[i_n, :nx, :ny] = corr_m_N.reshape(nx, ny)
+
+        tmp_cond_hist[i_n] += comp_cond_hist(box_ens_list, sum_ens_list,
+                                             valid, mean_m)
+
+        if inargs.var == 'm':
+            # This is the MEAN heating rate in each box for each member
+            tmp_var_ttens[i_n, :nx, :ny] = np.var(ttens_box, axis=0, ddof=1)
+            tmp_mean_ttens[i_n, :nx, :ny] = np.mean(ttens_box, axis=0)
+
+    result = {
+        'var_M': tmp_var_M,
+        'var_N': tmp_var_N,
+        'var_m': tmp_var_m,
+        'mean_M': tmp_mean_M,
+        'mean_N': tmp_mean_N,
+        'mean_m': tmp_mean_m,
+        'corr_m_N': tmp_corr_m_N,
+        'cond_m_hist': tmp_cond_hist,
+    }
+    if inargs.var == 'm':
+        result.update({'var_TTENS': tmp_var_ttens,
+                       'mean_TTENS': tmp_mean_ttens})
+    return result
+
+
+def write_var_mean(rootgroup, idate, it, result):
+    """
+    Save variances and means of one time step in rootgroup object. All
+    arrays, including the conditional histogram, are written to the slice of
+    this step, so a step which is computed again after a resume overwrites
+    its old values.
+
+    Parameters
+    ----------
+    rootgroup : NetCDF dataset object
+      To save data
+    idate : int
+      Date index
+    it : int
+      Time index
+    result : dict
+      Arrays returned by comp_var_mean
+    """
+    for var_name, tmp_array in result.items():
+        rootgroup.variables[var_name][idate, it] = tmp_array
+
+
+def coarse_grain_clouds(com_ens_list, sum_ens_list, n, nx, ny):
+    """
+    Sort the clouds of all ensemble members into the coarse boxes of size n
+    and compute the box sums and cloud numbers for each member.
+
+    Parameters
+    ----------
+    com_ens_list : list
+      list with centers of mass for each member
+    sum_ens_list : list
+      list with object sums for each member
+    n : int
+      Size of coarse boxes in grid points
+    nx, ny : int
+      Number of coarse boxes in x and y direction
+
+    Returns
+    -------
+    box_ens_list : list
+      List with flat box index (ico * ny + jco) of each cloud for each member.
+      Clouds outside of all boxes have index -1.
+    M : numpy.ndarray
+      Summed value of all clouds in box. Dimensions [ens_no, nx * ny]
+    N : numpy.ndarray
+      Number of clouds in box. Dimensions [ens_no, nx * ny]
+    """
+
+    nbox = nx * ny
+    box_ens_list = []
+    M = np.zeros((len(com_ens_list), nbox))
+    N = np.zeros((len(com_ens_list), nbox), dtype=int)
+    for ie, com_list, sum_list in zip(range(len(com_ens_list)), com_ens_list,
+                                      sum_ens_list):
+        # Get the box indices for each cloud, floor division is exact here
+        ico = com_list[:, 0] // n
+        jco = com_list[:, 1] // n
+        inside = ((ico >= 0) & (ico < nx) & (jco >= 0) & (jco < ny))
+        box = np.where(inside, ico * ny + jco, -1).astype(int)
+        box_ens_list.append(box)
+
+        M[ie] = np.bincount(box[inside], weights=sum_list[inside],
+                            minlength=nbox)
+        N[ie] = np.bincount(box[inside], minlength=nbox)
+
+    return box_ens_list, M, N
+
+
+def comp_cloud_moments(box_ens_list, sum_ens_list, nbox):
+    """
+    Compute number, sum and sum of squared deviations from the box mean of
+    the clouds of all members in each box.
+
+    Parameters
+    ----------
+    box_ens_list : list
+      List with flat box index of each cloud for each member
+    sum_ens_list : list
+      list with object sums for each member
+    nbox : int
+      Number of boxes
+
+    Returns
+    -------
+    moments : tuple
+      (N_all, S_all, M2_all) with one value for each box
+    """
+
+    # Pool all clouds of all members
+    box_all = np.concatenate(box_ens_list)
+    sum_all = np.concatenate(sum_ens_list)
+    inside = box_all >= 0
+    box_all = box_all[inside]
+    sum_all = sum_all[inside]
+
+    # Two passes, the deviations are taken from the box mean
+    N_all = np.bincount(box_all, minlength=nbox)
+    S_all = np.bincount(box_all, weights=sum_all, minlength=nbox)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_all = S_all / N_all
+    dev = sum_all - mean_all[box_all]
+    M2_all = np.bincount(box_all, weights=dev * dev, minlength=nbox)
+
+    return N_all, S_all, M2_all
+
+
+def reduce_moments(M, N, moments, nx, ny):
+    """
+    Aggregate box sums, numbers and moments onto the boxes of twice the size
+    by summing up 2x2 neighboring boxes.
+
+    Parameters
+    ----------
+    M : numpy.ndarray
+      Summed value of all clouds in box. Dimensions [ens_no, nx * ny]
+    N : numpy.ndarray
+      Number of clouds in box. Dimensions [ens_no, nx * ny]
+    moments : tuple
+      (N_all, S_all, M2_all) for each box
+    nx, ny : int
+      Number of boxes in x and y direction, must be even
+
+    Returns
+    -------
+    M, N, moments : numpy.ndarray, numpy.ndarray, tuple
+      Same for the coarser boxes with dimensions [ens_no, nx / 2 * ny / 2]
+    """
+
+    def reduce_2x2(a):
+        a = a.reshape(a.shape[:-1] + (nx // 2, 2, ny // 2, 2))
+        return a.sum(axis=(-3, -1)).reshape(a.shape[:-4] + (-1,))
+
+    N_all, S_all, M2_all = moments
+    N_all_c = reduce_2x2(N_all)
+    S_all_c = reduce_2x2(S_all)
+
+    # Merge the sums of squared deviations of the four child boxes, the
+    # deviation of each child mean from the parent mean has to be added
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_all = S_all / N_all
+        mean_all_c = S_all_c / N_all_c
+    parent = np.arange(nx * ny)
+    parent = (parent // ny // 2) * (ny // 2) + (parent % ny) // 2
+    shift = np.where(N_all > 0, N_all * (mean_all - mean_all_c[parent]) ** 2,
+                     0.)
+    M2_all_c = reduce_2x2(M2_all) + reduce_2x2(shift)
+
+    return reduce_2x2(M), reduce_2x2(N), (N_all_c, S_all_c, M2_all_c)
+
+
+def coarsen_box_index(box_ens_list, nx, ny):
+    """
+    Convert the flat box indices of each cloud to the indices of the boxes of
+    twice the size.
+
+    Parameters
+    ----------
+    box_ens_list : list
+      List with flat box index of each cloud for each member
+    nx, ny : int
+      Number of boxes in x and y direction, must be even
+
+    Returns
+    -------
+    box_ens_list : list
+      List with flat coarse box index of each cloud for each member
+    """
+
+    coarse_list = []
+    for box in box_ens_list:
+        coarse = (box // ny // 2) * (ny // 2) + (box % ny) // 2
+        coarse_list.append(np.where(box >= 0, coarse, -1))
+    return coarse_list
+
+
+def is_scale_pyramid(n_list, irange, jrange):
+    """
+    Check whether the coarsening sizes are nested powers of two, so that each
+    scale can be aggregated from 2x2 boxes of the next smaller scale.
+
+    Parameters
+    ----------
+    n_list : list
+      Coarsening sizes
+    irange, jrange : int
+      Size of the analysis domain
+
+    Returns
+    -------
+    is_pyramid : bool
+    """
+    n_sorted = sorted(n_list)
+    if len(set(n_sorted)) != len(n_sorted):
+        return False
+    if (irange % n_sorted[-1] != 0) or (jrange % n_sorted[-1] != 0):
+        return False
+    return all([b == 2 * a for a, b in zip(n_sorted[:-1], n_sorted[1:])])
+
+
+def iter_coarse_scales(inargs, n_list, com_ens_list, sum_ens_list,
+                       ttens=None):
+    """
+    Generator which yields the coarse grained clouds for each scale.
+
+    By default the clouds are binned only once into the smallest boxes and
+    every larger scale is aggregated from 2x2 boxes of the scale below. If
+    inargs.no_pyramid is given or the scales are not nested powers of two,
+    each scale is computed directly from the cloud lists.
+
+    Parameters
+    ----------
+    inargs : argparse object
+      Argparse object with all input arguments
+    n_list : list
+      Coarsening sizes
+    com_ens_list : list
+      list with centers of mass for each member
+    sum_ens_list : list
+      list with object sums for each member
+    ttens : numpy.ndarray, optional
+      Heating rate field with dimensions [ens_no, x, y]. If given, the box
+      means for each member are also returned.
+
+    Yields
+    ------
+    i_n, nx, ny, box_ens_list, M, N, moments, ttens_box
+      Scale index, number of boxes, box index of each cloud, box sums and
+      numbers, moments of all clouds in box and mean heating rate in box
+      (None if ttens is None)
+    """
+
+    irange = get_config(inargs, 'domain', 'ana_irange')
+    jrange = get_config(inargs, 'domain', 'ana_jrange')
+
+    def box_mean(field, n, nx, ny):
+        return field[:, :nx * n, :ny * n].reshape(
+            field.shape[0], nx, n, ny, n).mean(axis=(2, 4))
+
+    if inargs.no_pyramid or not is_scale_pyramid(n_list, irange, jrange):
+        for i_n, n in enumerate(n_list):
+            nx = int(np.floor(irange / n))
+            ny = int(np.floor(jrange / n))
+            box_ens_list, M, N = coarse_grain_clouds(com_ens_list,
+                                                     sum_ens_list, n, nx, ny)
+            moments = comp_cloud_moments(box_ens_list, sum_ens_list, nx * ny)
+            ttens_box = None if ttens is None else box_mean(ttens, n, nx, ny)
+            yield i_n, nx, ny, box_ens_list, M, N, moments, ttens_box
+        return
+
+    # Start from the smallest scale and aggregate upwards
+    order = np.argsort(n_list)
+    n = n_list[order[0]]
+    nx = irange // n
+    ny = jrange // n
+    box_ens_list, M, N = coarse_grain_clouds(com_ens_list, sum_ens_list, n,
+                                             nx, ny)
+    moments = comp_cloud_moments(box_ens_list, sum_ens_list, nx * ny)
+    ttens_box = None if ttens is None else box_mean(ttens, n, nx, ny)
+    for level, i_n in enumerate(order):
+        if level > 0:
+            M, N, moments = reduce_moments(M, N, moments, nx, ny)
+            box_ens_list = coarsen_box_index(box_ens_list, nx, ny)
+            if ttens_box is not None:
+                ttens_box = box_mean(ttens_box, 2, nx // 2, ny // 2)
+            nx //= 2
+            ny //= 2
+        yield i_n, nx, ny, box_ens_list, M, N, moments, ttens_box
+
+
+def comp_box_stats(inargs, M, N, moments):
+    """
+    Compute variances, means and correlations for all coarse boxes at once.
+    Boxes with fewer than inargs.minobj members with clouds are set to nan.
+
+    Parameters
+    ----------
+    inargs : argparse object
+      Argparse object with all input arguments
+    M : numpy.ndarray
+      Summed value of all clouds in box. Dimensions [ens_no, box]
+    N : numpy.ndarray
+      Number of clouds in box. Dimensions [ens_no, box]
+    moments : tuple
+      (N_all, S_all, M2_all) of all clouds of all members in each box
+
+    Returns
+    -------
+    valid : numpy.ndarray
+      True for boxes where statistics are computed
+    var_M, var_N, var_m, mean_M, mean_N, mean_m, corr_m_N : numpy.ndarray
+      Statistics for each box
+    """
+
+    N_all, S_all, M2_all = moments
+
+    # Check if x number of members have clouds in them
+    valid = np.sum(N > 0, axis=0) >= inargs.minobj
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Mean and variance of all clouds in box
+        mean_m = S_all / N_all
+        var_m = M2_all / (N_all - 1)
+        var_m[N_all < 2] = np.nan
+
+        # Ensemble statistics of box sums and numbers
+        var_M = np.var(M, axis=0, ddof=1)
+        var_N = np.var(N, axis=0, ddof=1)
+        mean_M = np.mean(M, axis=0)
+        mean_N = np.mean(N, axis=0)
+
+        # Correlation of mean m in each member and N, mean m is zero if empty
+        m_box = np.where(N > 0, M / N, 0.)
+        dm = m_box - np.mean(m_box, axis=0)
+        dN = N - mean_N
+        corr_m_N = (np.sum(dm * dN, axis=0) /
+                    np.sqrt(np.sum(dm * dm, axis=0) * np.sum(dN * dN, axis=0)))
+        corr_m_N = np.clip(corr_m_N, -1, 1)
+
+    stats = [var_M, var_N, var_m, mean_M, mean_N, mean_m, corr_m_N]
+    stats = [np.where(valid, s, np.nan) for s in stats]
+    return [valid] + stats
+
+
+def comp_cond_hist(box_ens_list, sum_ens_list, valid, mean_m):
+    """
+    Compute histogram of cloud sums conditioned on the mean cloud sum of the
+    coarse box.
+
+    Parameters
+    ----------
+    box_ens_list : list
+      List with flat box index of each cloud for each member
+    sum_ens_list : list
+      list with object sums for each member
+    valid : numpy.ndarray
+      True for boxes which are counted
+    mean_m : numpy.ndarray
+      Mean cloud sum in each box
+
+    Returns
+    -------
+    cond_hist : numpy.ndarray
+      Histogram with dimensions [cond_bins_mean_m, cond_bins_m]
+    """
+    m_edges = np.linspace(0, 2e8, 10)   # TODO: Softcode!
+    edges = np.linspace(0, 1e9, 50)
+    cond_hist = np.zeros((m_edges.shape[0] - 1, edges.shape[0] - 1))
+
+    box_all = np.concatenate(box_ens_list)
+    sum_all = np.concatenate(sum_ens_list)
+    inside = box_all >= 0
+    box_all = box_all[inside]
+    sum_all = sum_all[inside]
+
+    # Bin of mean m for each box and for each cloud in a valid box
+    m_bin = np.digitize(mean_m, m_edges[1:-1], right=True)
+    cld_valid = valid[box_all]
+    cld_m_bin = m_bin[box_all][cld_valid]
+    sum_all = sum_all[cld_valid]
+
+    for b in np.unique(cld_m_bin):
+        cond_hist[b] += np.histogram(sum_all[cld_m_bin == b], edges)[0]
+    return cond_hist
 
 
 ################################################################################
@@ -300,7 +876,9 @@ def comp_var_mean(inargs, idate, it, rootgroup, com_ens_list, sum_ens_list,
 
 def plot_diurnal(inargs):
     """
-    Plots the diurnal plots for three different scales.
+    Plots the diurnal plots for three different scales. The statistics are
+    read from the summary file, unless an external mean m is given, in which
+    case they are computed from the pre-processed file.
 
     Parameters
     ----------
@@ -310,8 +888,10 @@ def plot_diurnal(inargs):
     """
 
     # Load dataset
-    rootgroup = read_netcdf_dataset(inargs)
-    # The variables have dimensions [date, time, n, x[n], y[n]]
+    if inargs.diurnal_ext_m is None:
+        rootgroup = read_summary_dataset(inargs)
+    else:
+        rootgroup = read_netcdf_dataset(inargs)
 
     # Set up figure
     pw = get_config(inargs, 'plotting', 'page_width')
@@ -337,82 +917,21 @@ def plot_diurnal(inargs):
     # Do some further calculations to get daily composite
     for i, i_n in enumerate(inargs.diurnal_scale_inds):
         n = rootgroup.variables['n'][i_n]
-        nx = int(np.floor(get_config(inargs, 'domain', 'ana_irange') / n))
-        ny = int(np.floor(get_config(inargs, 'domain', 'ana_jrange') / n))
         label = labellist[i] + str(int(n * 2.8)) + 'km'
 
-        mean_M = rootgroup.variables['mean_M'][:, :, i_n, :nx, :ny]
-        mean_m = rootgroup.variables['mean_m'][:, :, i_n, :nx, :ny]
-        mean_N = rootgroup.variables['mean_N'][:, :, i_n, :nx, :ny]
-        var_M = rootgroup.variables['var_M'][:, :, i_n, :nx, :ny]
-        var_m = rootgroup.variables['var_m'][:, :, i_n, :nx, :ny]
-        var_N = rootgroup.variables['var_N'][:, :, i_n, :nx, :ny]
-        try:
-            corr_m_N = rootgroup.variables['corr_m_N'][:, :, i_n, :nx, :ny]
-        except:
-            print 'hi'
+        ylabel = get_diurnal_ylabel(inargs)
 
-        # Flatten x and y dimensions
-        mean_M = mean_M.reshape(mean_M.shape[0], mean_M.shape[1],
-                       mean_M.shape[2] * mean_M.shape[3])
-        mean_m = mean_m.reshape(mean_m.shape[0], mean_m.shape[1],
-                                mean_m.shape[2] * mean_m.shape[3])
-        mean_N = mean_N.reshape(mean_N.shape[0], mean_N.shape[1],
-                                mean_N.shape[2] * mean_N.shape[3])
-        var_M = var_M.reshape(var_M.shape[0], var_M.shape[1],
-                              var_M.shape[2] * var_M.shape[3])
-        var_m = var_m.reshape(var_m.shape[0], var_m.shape[1],
-                              var_m.shape[2] * var_m.shape[3])
-        var_N = var_N.reshape(var_N.shape[0], var_N.shape[1],
-                              var_N.shape[2] * var_N.shape[3])
-        try:
-            corr_m_N = corr_m_N.reshape(corr_m_N.shape[0], corr_m_N.shape[1],
-                                        corr_m_N.shape[2] * corr_m_N.shape[3])
-        except:
-            pass
-        # Array now has dimensions [date, time, points]
-
-        if inargs.diurnal_ext_m is not None:
-            mean_m = inargs.diurnal_ext_m
-
-        # Computations
-        if inargs.plot_type == 'r_v':
-            data = var_M / (2. * mean_M * mean_m)
-            ylabel = r'$R_V$'
-            if inargs.diurnal_ext_m is not None:
-                ylabel += r' with fixed $\langle m \rangle$'
-        elif inargs.plot_type == 'alpha':
-            data = var_N / mean_N
-            ylabel = r'$\alpha$'
-        elif inargs.plot_type == 'beta':
-            data = var_m / (mean_m**2)
-            ylabel = r'$\beta$'
-        elif inargs.plot_type == 'r_v_alpha':
-            data = var_M / ((1 + var_N / mean_N) * mean_M * mean_m)
-            ylabel = r'$\alpha$-adjusted $R_V$'
-        elif inargs.plot_type == 'r_v_beta':
-            data = var_M / ((1 + var_m / (mean_m**2)) * mean_M * mean_m)
-            ylabel = r'$\beta$-adjusted $R_V$'
-        elif inargs.plot_type == 'r_v_alpha_beta':
-            data = var_M / ((var_N / mean_N + var_m / (mean_m**2)) * mean_M *
-                            mean_m)
-            ylabel = r'$\alpha$ and $\beta$-adjusted $R_V$'
-        elif inargs.plot_type == 'corr_m_N':
-            data = corr_m_N
-            ylabel = r'corr($m$, $N$)'
-        elif inargs.plot_type == 'mean_m':
-            data = mean_m
-            ylabel = r'mean(m)'
+        stats = get_diurnal_stats(inargs, rootgroup, i_n)
 
         if inargs.diurnal_individual_days:
             for iday, date in enumerate(rootgroup.variables['date']):
                 plot_individual_panel(inargs, rootgroup, i, iday, axflat,
-                                      n_cols, n_rows, ylabel, data, label,
+                                      n_cols, n_rows, ylabel, stats, label,
                                       clist)
 
         else:
-            plot_composite(inargs, rootgroup, i, data, ax, label, clist,
-                           ylabel)
+            plot_composite(inargs, rootgroup, i, ax, label, clist, ylabel,
+                           stats)
 
     # Finish figure
     if inargs.diurnal_individual_days and inargs.diurnal_legend:
@@ -429,8 +948,254 @@ def plot_diurnal(inargs):
                      str(inargs.diurnal_individual_days))
 
 
+# Variables of the pp file needed for each diurnal plot type
+diurnal_vars = {
+    'r_v': ['var_M', 'mean_M', 'mean_m'],
+    'alpha': ['var_N', 'mean_N'],
+    'beta': ['var_m', 'mean_m'],
+    'r_v_alpha': ['var_M', 'var_N', 'mean_N', 'mean_M', 'mean_m'],
+    'r_v_beta': ['var_M', 'var_m', 'mean_M', 'mean_m'],
+    'r_v_alpha_beta': ['var_M', 'var_N', 'mean_N', 'var_m', 'mean_M',
+                       'mean_m'],
+    'corr_m_N': ['corr_m_N'],
+    'mean_m': ['mean_m'],
+}
+
+# Statistics of the diurnal plot types with their dimensions in the summary
+# file. comp_* are composites over all dates and points, day_* are taken over
+# the points of each date.
+diurnal_stats = {
+    'comp_mean': ['n', 'time'],
+    'comp_per25': ['n', 'time'],
+    'comp_per75': ['n', 'time'],
+    'day_mean': ['date', 'n', 'time'],
+    'day_per25': ['date', 'n', 'time'],
+    'day_per75': ['date', 'n', 'time'],
+    'num_nan': ['n'],
+    'num_tot': ['n'],
+}
+
+
+def read_diurnal_fields(inargs, rootgroup, var_list, i_n, nx, ny, ext_m=None,
+                        idates=slice(None), itimes=slice(None)):
+    """
+    Reads the variables in var_list for the given dates and times of one
+    scale. Only the requested slab is read from the pp file. If ext_m is
+    given, mean_m is replaced by this fixed value.
+
+    Parameters
+    ----------
+    inargs : argparse object
+      Argparse object with all input arguments
+    rootgroup : NetCDF dataset object
+      pp file
+    var_list : list
+      Variables to read
+    i_n : int
+      Scale index
+    nx, ny : int
+      Number of boxes in x and y for this scale
+    ext_m : float
+      If given, fixed value for mean_m
+    idates : slice
+      Dates to read
+    itimes : slice
+      Times to read
+
+    Returns
+    -------
+    fields : dict
+      Arrays with dimensions [date, time, points] for each variable
+    """
+    fields = {}
+    for var in var_list:
+        if var == 'mean_m' and ext_m is not None:
+            # Same shape as the other fields
+            shape = np.empty(rootgroup.variables[var].shape[:2])[
+                idates, itimes].shape
+            fields[var] = np.full(shape + (nx * ny,), ext_m)
+            continue
+        tmp = np.ma.filled(rootgroup.variables[var][idates, itimes, i_n,
+                                                    :nx, :ny], np.nan)
+        # Flatten x and y dimensions
+        fields[var] = tmp.reshape(tmp.shape[0], tmp.shape[1],
+                                  tmp.shape[2] * tmp.shape[3])
+    return fields
+
+
+def calc_diurnal_data(plot_type, fields):
+    """
+    Computes the quantity to be plotted for a diurnal plot type.
+
+    Parameters
+    ----------
+    plot_type : str
+      Diurnal plot type
+    fields : dict
+      Fields from read_diurnal_fields
+
+    Returns
+    -------
+    data : numpy array
+      Array with dimensions [date, time, points]
+    """
+    if plot_type == 'r_v':
+        data = fields['var_M'] / (2. * fields['mean_M'] * fields['mean_m'])
+    elif plot_type == 'alpha':
+        data = fields['var_N'] / fields['mean_N']
+    elif plot_type == 'beta':
+        data = fields['var_m'] / (fields['mean_m']**2)
+    elif plot_type == 'r_v_alpha':
+        data = fields['var_M'] / ((1 + fields['var_N'] / fields['mean_N']) *
+                                  fields['mean_M'] * fields['mean_m'])
+    elif plot_type == 'r_v_beta':
+        data = fields['var_M'] / ((1 + fields['var_m'] /
+                                   (fields['mean_m']**2)) *
+                                  fields['mean_M'] * fields['mean_m'])
+    elif plot_type == 'r_v_alpha_beta':
+        data = fields['var_M'] / ((fields['var_N'] / fields['mean_N'] +
+                                   fields['var_m'] / (fields['mean_m']**2)) *
+                                  fields['mean_M'] * fields['mean_m'])
+    elif plot_type == 'corr_m_N':
+        data = fields['corr_m_N']
+    elif plot_type == 'mean_m':
+        data = fields['mean_m']
+    return data
+
+
+def comp_diurnal_stats(inargs, rootgroup, i_n, plot_types, ext_m=None):
+    """
+    Computes the statistics in diurnal_stats of one scale for the given plot
+    types. The fields are read for one time step after the other, so that
+    only one time step of all dates is kept in memory, and each field is read
+    only once for all plot types.
+
+    Parameters
+    ----------
+    inargs : argparse object
+      Argparse object with all input arguments
+    rootgroup : NetCDF dataset object
+      pp file
+    i_n : int
+      Scale index
+    plot_types : list
+      Diurnal plot types
+    ext_m : float
+      If given, fixed value for mean_m
+
+    Returns
+    -------
+    stats : dict
+      Dictionary with a dictionary of the statistics for each plot type
+    """
+    n = rootgroup.variables['n'][i_n]
+    nx = int(np.floor(get_config(inargs, 'domain', 'ana_irange') / n))
+    ny = int(np.floor(get_config(inargs, 'domain', 'ana_jrange') / n))
+    ndate = rootgroup.dimensions['date'].size
+    ntime = rootgroup.dimensions['time'].size
+    var_list = sorted(set(sum([diurnal_vars[p] for p in plot_types], [])))
+
+    stats = {}
+    for plot_type in plot_types:
+        stats[plot_type] = {
+            'comp_mean': np.zeros(ntime),
+            'comp_per25': np.zeros(ntime),
+            'comp_per75': np.zeros(ntime),
+            'day_mean': np.zeros((ndate, ntime)),
+            'day_per25': np.zeros((ndate, ntime)),
+            'day_per75': np.zeros((ndate, ntime)),
+            'num_nan': 0,
+            'num_tot': 0,
+        }
+
+    for it in range(ntime):
+        fields = read_diurnal_fields(inargs, rootgroup, var_list, i_n, nx, ny,
+                                     ext_m=ext_m, itimes=slice(it, it + 1))
+        for plot_type in plot_types:
+            data = calc_diurnal_data(plot_type, fields)
+            s = stats[plot_type]
+            s['num_nan'] += np.isnan(data).sum()
+            s['num_tot'] += data.size
+            s['comp_mean'][it] = np.nanmean(data)
+            s['comp_per25'][it] = np.nanpercentile(data, 25)
+            s['comp_per75'][it] = np.nanpercentile(data, 75)
+            s['day_mean'][:, it] = np.nanmean(data[:, 0], axis=1)
+            s['day_per25'][:, it] = np.nanpercentile(data[:, 0], 25, axis=1)
+            s['day_per75'][:, it] = np.nanpercentile(data[:, 0], 75, axis=1)
+    return stats
+
+
+def get_diurnal_stats(inargs, rootgroup, i_n):
+    """
+    Returns the statistics in diurnal_stats of one scale for
+    inargs.plot_type, either from the summary file or, if an external mean m
+    is given, computed from the pp file.
+
+    Parameters
+    ----------
+    inargs : argparse object
+      Argparse object with all input arguments
+    rootgroup : NetCDF dataset object
+      Summary file or pp file if inargs.diurnal_ext_m is given
+    i_n : int
+      Scale index
+
+    Returns
+    -------
+    stats : dict
+      Dictionary with the statistics
+    """
+    if inargs.diurnal_ext_m is not None:
+        return comp_diurnal_stats(inargs, rootgroup, i_n, [inargs.plot_type],
+                                  ext_m=inargs.diurnal_ext_m)[inargs.plot_type]
+
+    stats = {}
+    for stat, stat_dims in diurnal_stats.items():
+        var = rootgroup.variables[inargs.plot_type + '_' + stat]
+        if stat_dims[0] == 'date':
+            stats[stat] = var[:, i_n]
+        else:
+            stats[stat] = var[i_n]
+    return stats
+
+
+def get_diurnal_ylabel(inargs):
+    """
+    Returns the ylabel for the diurnal plot type.
+
+    Parameters
+    ----------
+    inargs : argparse object
+      Argparse object with all input arguments
+
+    Returns
+    -------
+    ylabel : str
+      ylabel
+    """
+    if inargs.plot_type == 'r_v':
+        ylabel = r'$R_V$'
+        if inargs.diurnal_ext_m is not None:
+            ylabel += r' with fixed $\langle m \rangle$'
+    elif inargs.plot_type == 'alpha':
+        ylabel = r'$\alpha$'
+    elif inargs.plot_type == 'beta':
+        ylabel = r'$\beta$'
+    elif inargs.plot_type == 'r_v_alpha':
+        ylabel = r'$\alpha$-adjusted $R_V$'
+    elif inargs.plot_type == 'r_v_beta':
+        ylabel = r'$\beta$-adjusted $R_V$'
+    elif inargs.plot_type == 'r_v_alpha_beta':
+        ylabel = r'$\alpha$ and $\beta$-adjusted $R_V$'
+    elif inargs.plot_type == 'corr_m_N':
+        ylabel = r'corr($m$, $N$)'
+    elif inargs.plot_type == 'mean_m':
+        ylabel = r'mean(m)'
+    return ylabel
+
+
 def plot_individual_panel(inargs, rootgroup, i, iday, axflat, n_cols, n_rows,
-                          ylabel, data, label, clist):
+                          ylabel, stats, label, clist):
     """
     Plots the individual panels of the diurnal plots for each day.
 
@@ -452,8 +1217,8 @@ def plot_individual_panel(inargs, rootgroup, i, iday, axflat, n_cols, n_rows,
       Number of rows
     ylabel : str
       ylabel
-    data : array
-      Data to be plotted
+    stats : dict
+      Statistics from get_diurnal_stats
     label : str
       Label string
     clist : list
@@ -499,9 +1264,9 @@ def plot_individual_panel(inargs, rootgroup, i, iday, axflat, n_cols, n_rows,
                 ax.set_xticks([0, 6, 12, 18, 24])
 
     # Get the data to be plotted
-    daily_mean = np.nanmean(data[iday], axis=1)
-    per25 = np.nanpercentile(data[iday], 25, axis=1)
-    per75 = np.nanpercentile(data[iday], 75, axis=1)
+    daily_mean = stats['day_mean'][iday]
+    per25 = stats['day_per25'][iday]
+    per75 = stats['day_per75'][iday]
 
     ax.plot(rootgroup.variables['time'][:], daily_mean,
                       label=label, c=clist[i], zorder=1)
@@ -512,7 +1277,7 @@ def plot_individual_panel(inargs, rootgroup, i, iday, axflat, n_cols, n_rows,
                               alpha=0.3, zorder=0.5)
 
 
-def plot_composite(inargs, rootgroup, i, data, ax, label, clist, ylabel):
+def plot_composite(inargs, rootgroup, i, ax, label, clist, ylabel, stats):
     """
     Plots composite panel for diurnal plots.
 
@@ -524,8 +1289,6 @@ def plot_composite(inargs, rootgroup, i, data, ax, label, clist, ylabel):
       Contains the data to be plotted
     i : int
       Scale index
-    data : array
-      Data to be plotted
     ax : axis object
     label : str
       Label string
@@ -533,20 +1296,22 @@ def plot_composite(inargs, rootgroup, i, data, ax, label, clist, ylabel):
       List with colors
     ylabel : str
       ylabel
+    stats : dict
+      Statistics from get_diurnal_stats
 
     """
 
+    composite_mean = stats['comp_mean']
+    per25 = stats['comp_per25']
+    per75 = stats['comp_per75']
+    num_nan = stats['num_nan']
+    num_tot = stats['num_tot']
+
     # Check how many nans there are in dataset
-    num_nan = np.isnan(data).sum()
-    num_tot = data.size
     print('Scale index: %i' % (i))
     print('Number of NaNs: %.2e/%.2e' % (num_nan, num_tot))
     print('Percentage of NaNs: %.2f' % (np.float(num_nan) / num_tot * 100.))
 
-    composite_mean = np.nanmean(data, axis=(0,2))
-    per25 = np.nanpercentile(data, 25, axis=(0,2))
-    per75 = np.nanpercentile(data, 75, axis=(0,2))
-
     ax.plot(rootgroup.variables['time'][:], composite_mean,
             label=label, c=clist[i], zorder=1,
             linewidth=2)
@@ -791,6 +1556,50 @@ def plot_correlation(inargs):
     save_fig_and_log(fig, rootgroup, inargs, 'correlation', tight=True)
 
 
+def comp_CC06b_fig9(inargs, rootgroup):
+    """
+    Computes the data for plot_CC06b_fig9, the mean normalized variance of M
+    and the mean of 2/N for each scale. The means are accumulated over chunks
+    of dates.
+
+    Parameters
+    ----------
+    inargs : argparse object
+      Argparse object with all input arguments
+    rootgroup : NetCDF dataset object
+      pp file
+
+    Returns
+    -------
+    x_data, y_data : numpy arrays
+      Square roots of the means of 2/N and Var(M)/M**2 for each scale
+    """
+
+    # [date, time, n, x, y]
+    n_dates = rootgroup.dimensions['date'].size
+    n_n = rootgroup.dimensions['n'].size
+    date_chunk = get_config(inargs, 'plotting', 'date_chunk')
+    y_sum = np.zeros(n_n)
+    y_count = np.zeros(n_n)
+    x_sum = np.zeros(n_n)
+    x_count = np.zeros(n_n)
+    for i_start in range(0, n_dates, date_chunk):
+        idates = slice(i_start, i_start + date_chunk)
+        var_M = rootgroup.variables['var_M'][idates]
+        mean_M = rootgroup.variables['mean_M'][idates]
+        mean_N = rootgroup.variables['mean_N'][idates]
+
+        y_data = var_M / (mean_M ** 2)
+        y_sum += np.nansum(y_data, axis=(0, 1, 3, 4))
+        y_count += np.sum(~np.isnan(y_data), axis=(0, 1, 3, 4))
+        x_data = 2. / mean_N
+        x_sum += np.nansum(x_data, axis=(0, 1, 3, 4))
+        x_count += np.sum(~np.isnan(x_data), axis=(0, 1, 3, 4))
+    y_data = np.sqrt(y_sum / y_count)
+    x_data = np.sqrt(x_sum / x_count)
+    return x_data, y_data
+
+
 def plot_CC06b_fig9(inargs):
     """Plots square root of normalized variance against square root of 1/N
     
@@ -801,21 +1610,14 @@ def plot_CC06b_fig9(inargs):
 
     """
 
-    # Read pre-processed data
-    rootgroup = read_netcdf_dataset(inargs)
+    # Read data from summary file
+    rootgroup = read_summary_dataset(inargs)
 
     pw = get_config(inargs, 'plotting', 'page_width')
     fig, ax = plt.subplots(1, 1, figsize=(pw/ 2.5, pw / 2.5))
 
-    # [date, time, n, x, y]
-    var_M = rootgroup.variables['var_M'][:, :, :, :, :]
-    mean_M = rootgroup.variables['mean_M'][:, :, :, :, :]
-    mean_N = rootgroup.variables['mean_N'][:, :, :, :, :]
-
-    y_data = var_M / (mean_M ** 2)
-    y_data = np.sqrt(np.nanmean(y_data, axis=(0, 1, 3, 4)))
-    x_data = 2. / mean_N
-    x_data = np.sqrt(np.nanmean(x_data, axis=(0, 1, 3, 4)))
+    x_data = rootgroup.variables['fig9_x'][:]
+    y_data = rootgroup.variables['fig9_y'][:]
 
     # axarr[0].plot(rootgroup.variables['time'][:], mean_m, label='non-separated')
     # axarr[1].plot(rootgroup.variables['time'][:], mean_M, label='non-separated')
@@ -843,14 +1645,19 @@ def main(inargs):
       Argparse object with all input arguments
     """
 
-    # Check if pre-processed file exists
-    if (pp_exists(inargs) is False) or (inargs.recompute is True):
+    # Check if pre-processed file exists and is complete
+    if (pp_complete(inargs) is False) or (inargs.recompute is True):
         print('Compute preprocessed file: ' + get_pp_fn(inargs))
         # Call preprocessing routine with arguments
         compute_variance(inargs)
     else:
         print('Found pre-processed file: ' + get_pp_fn(inargs))
 
+    # Compute the statistics of all diurnal plot types once
+    if (summary_complete(inargs) is False) or (inargs.recompute is True):
+        print('Compute summary file: ' + get_summary_fn(inargs))
+        create_summary(inargs)
+
     # Plotting
     if inargs.plot_type in ['r_v', 'alpha', 'beta', 'r_v_alpha', 'r_v_beta',
                             'r_v_alpha_beta', 'corr_m_N', 'mean_m']:
@@ -923,6 +1730,18 @@ if __name__ == '__main__':
                         type=int,
                         default=3,
                         help='Size of search matrix for cloud separation')
+    parser.add_argument('--no_pyramid',
+                        dest='no_pyramid',
+                        action='store_true',
+                        help='If given, coarse grain each scale directly from '
+                             'the clouds instead of aggregating 2x2 boxes of '
+                             'the next smaller scale.')
+    parser.set_defaults(no_pyramid=False)
+    parser.add_argument('--workers',
+                        type=int,
+                        default=1,
+                        help='Number of processes for the preprocessing. '
+                             'Default = 1')
 
     # Plotting arguments
     parser.add_argument('--plot_type',
@@ -1018,6 +1837,13 @@ if __name__ == '__main__':
                         help='If True, recompute pre-processed file.')
     parser.set_defaults(recompute=False)
 
+    # Arguments which change the pre-processed file
+    parser.set_defaults(pp_args=['date_start', 'date_end', 'time_start',
+                                 'time_end', 'time_inc', 'nens', 'var', 'lvl',
+                                 'minobj', 'thresh', 'sep', 'footprint',
+                                 'no_pyramid'],
+                        pp_version='variability-2')
+
     args = parser.parse_args()
 
     main(args)
\ No newline at end of file
@@ -11,9 +11,9 @@ import argparse
 from netCDF4 import Dataset
 from datetime import datetime, timedelta
 from helpers import make_datelist, get_radar_mask, get_pp_fn, \
-    get_datalist_radar, create_log_str, get_datalist_model, \
-    read_netcdf_dataset, get_config, save_fig_and_log, pp_exists, \
-    get_composite_str, load_raw_data
+    create_log_str, read_netcdf_dataset, get_config, save_fig_and_log, \
+    pp_exists, get_composite_str, load_raw_data, create_storage_variable, \
+    add_pp_fn_to_index
 import numpy as np
 import matplotlib.pyplot as plt
 
@@ -53,6 +53,7 @@ def create_netcdf(inargs, groups, dimensions, variables,
     # Create NetCDF file
     rootgroup = Dataset(pp_fn, 'w', format='NETCDF4')
     rootgroup.log = create_log_str(inargs, 'Preprocessing')
+    add_pp_fn_to_index(inargs)
 
     # Create root dimensions and variables
     for dim_name, dim_val in dimensions.items():
@@ -78,14 +79,16 @@ def create_netcdf(inargs, groups, dimensions, variables,
 
         # Create variables
         for var_name, var_dims in variables.items():
-            rootgroup.groups[g].createVariable(var_name, 'f8', var_dims)
+            create_storage_variable(inargs, rootgroup.groups[g], var_name,
+                                    var_dims, dtype_key='pp_dtype')
     return rootgroup
 
 
-def compute_ts_mean(inargs, idate, date, group, ie, var, rootgroup,
+def compute_ts_mean(inargs, idate, group, ie, raw_data, rootgroup,
                     radar_mask):
     """
-    Compute mean time series and appends it to rootgroup object.
+    Compute mean time series of all variables of a group and appends them to
+    rootgroup object.
 
     Parameters
     ----------
@@ -93,41 +96,29 @@ def compute_ts_mean(inargs, idate, date, group, ie, var, rootgroup,
       Argparse object with all input arguments
     idate : int
       index of date
-    date : str
-      Date to analyze
     group : str
       Group name
     ie  : int 
       Ensemble Member
-    var : str 
-      COSMO variable to analyze
+    raw_data : NetCDF Dataset object
+      Preloaded fields of the group
     rootgroup : NetCDF Dataset object
       NetCDF rootgroup
     radar_mask : np.array
-      Total radar mask
+      Boolean radar mask, [i, j] or [time, i, j] for hourly masks
 
     """
-    if group in ['det', 'ens']:
-        if group == 'det':
-            ens_no = 'det'
-        else:
-            ens_no = ie + 1
-        datalist = get_datalist_model(inargs, date, ens_no, var)
-    elif group == 'obs':
-        if not var == 'PREC_ACCUM':
-            return
-        datalist = get_datalist_radar(inargs, date)
-    else:
-        raise Exception('Wrong group.')
-
+    for var in raw_data.variables:
+        if var not in rootgroup.groups[group].variables:
+            continue
+        data = raw_data.variables[var][idate, :, ie]
 
-
-    # Compute domain mean and save in NetCDF file
-    # Note: Need to loop, because array operation ignores mask
-    mean_ts = []
-    for data in datalist:
-        mean_ts.append(np.mean(data[~radar_mask]))
-    rootgroup.groups[group].variables[var][idate, :, ie] = np.array(mean_ts)
+        # Domain mean as weighted sum over [time, x, y], weights are zero for
+        # radar masked and missing values
+        weights = ~(np.ma.getmaskarray(data) | radar_mask)
+        mean_ts = (np.sum(np.ma.getdata(data) * weights, axis=(1, 2)) /
+                   np.sum(weights, axis=(1, 2)))
+        rootgroup.groups[group].variables[var][idate, :, ie] = mean_ts
 
 
 def domain_mean_weather_ts(inargs):
@@ -176,23 +167,24 @@ def domain_mean_weather_ts(inargs):
     print('Number of masked grid points: ' + str(np.sum(radar_mask)) +
           ' from total grid points: ' + str(radar_mask.size))
 
-    # Load analysis data and store in NetCDF
-    for idate, date in enumerate(make_datelist(inargs)):
-        print('Computing time series for: ' + date)
+    # Load preloaded fields and store mean time series in NetCDF
+    for group in rootgroup.groups:
+        if group == 'obs':
+            var_list = ['PREC_ACCUM']
+        else:
+            var_list = sorted(variables.keys())
+        raw_data = load_raw_data(inargs, var_list, group)
 
-        # Determine radar mask
-        if inargs.radar_mask == 'total':
-            tmp_mask = np.any(radar_mask, axis=(0, 1))
-        elif inargs.radar_mask == 'day':
-            tmp_mask = np.any(radar_mask[idate], axis=0)
-        elif inargs.radar_mask == 'hour':
-            tmp_mask = radar_mask[idate]
+        for idate, date in enumerate(make_datelist(inargs)):
+            print('Computing time series for: ' + group + ' ' + date)
+
+            # Determine radar mask
+            tmp_mask = get_radar_mask(inargs, inargs.radar_mask, idate)
 
-        for group in rootgroup.groups:
             for ie in range(rootgroup.groups[group].dimensions['ens_no'].size):
-                for var in rootgroup.groups[group].variables:
-                    compute_ts_mean(inargs, idate, date, group, ie, var,
-                                    rootgroup, tmp_mask)
+                compute_ts_mean(inargs, idate, group, ie, raw_data, rootgroup,
+                                tmp_mask)
+        raw_data.close()
 
     # Close NetCDF file
     rootgroup.close()
@@ -573,6 +565,12 @@ if __name__ == '__main__':
                         help='If True, recompute pre-processed file.')
     parser.set_defaults(recompute=False)
 
+    # Arguments which change the pre-processed file
+    parser.set_defaults(pp_args=['date_start', 'date_end', 'time_start',
+                                 'time_end', 'time_inc', 'nens', 'radar_mask',
+                                 'compute_tauc_hpbl'],
+                        pp_version='weather_time_series-1')
+
     args = parser.parse_args()
 
     main(args)
\ No newline at end of file